@@ -1,193 +1,202 @@
-from tree import ListBasedBinaryTree
-from svg import SVGElement
-
-NODE_RADIUS = 20
-NODE_DIAMETER = NODE_RADIUS * 2
-MIN_NODE_X_SPACING = 15
-NODE_TEXT_SIZE = 20
-NODE_Y_SPACING = 8
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from tree import (BinaryTree, ListBasedBinaryTree, SparseBinaryTree, cleanLabel,
+                  parseCompactTree)
+from svg import SVGElement, SVGShapeGroup
+from layout import layoutBinaryTree, TreeLayout
+from styles import (LabelTable, normalizePalette, NODE_TEXT_SIZE,
+                    NODE_FONT_FAMILY)
+
 NODE_OUTLINE_WIDTH = 3
-# these need only affect the viewbox:
-VERTICAL_MARGIN = 10
-HORIZONTAL_MARGIN = 10
+# the dashes of ghost nodes and the edges leading to them
+DASH_LENGTH = 4
+# the ids of the groups of edges, circles, squares and labels, in drawing order,
+# when shapes are drawn with ids
+SHAPE_GROUP_IDS = ("edges", "circles", "squares", "labels")
 
 
-def visualizeBinaryTree(tree: ListBasedBinaryTree,
+def visualizeBinaryTree(tree: BinaryTree,
                         addBlankExternalNodes: bool = False,
                         makeBlankExternalNodesBlack: bool = True,
-                        addWhiteBG: bool = False):
-    """Produces an SVG that visualizes the tree. For simplicity, the root node is
-    placed at the origin of the SVG's coordinate system and the viewBox is built
-    around that. If addBlankExternalNodes is True, then no existing nodes will be
-    drawn external, but each of them will be given a placeholder external left and
-    right child, if necessary."""
-    numLevels = tree.height if not addBlankExternalNodes else tree.height + 1
-    finalHeight = numLevels * NODE_DIAMETER + (numLevels - 1) * NODE_Y_SPACING
-    nodesInLastLevel = tree.getMaxNodeCountByLevel(numLevels)
-    # returns the distance between the left edge of the leftmost circle and the right
-    # edge of the rightmost circle
-
-    def getRowWidthByNodeCount(x): return x * NODE_DIAMETER + (
-        x - 1) * MIN_NODE_X_SPACING
-    finalWidth = getRowWidthByNodeCount(nodesInLastLevel)
-    lowestCenterX = -finalWidth / 2 + NODE_RADIUS
-    # SVG viewbox format is "minX minY width height"
-    viewBox = (f"{(-finalWidth/2)-HORIZONTAL_MARGIN} " +
-               f"{-NODE_RADIUS-VERTICAL_MARGIN} "
-               f"{finalWidth + HORIZONTAL_MARGIN*2} " +
-               f"{finalHeight + VERTICAL_MARGIN*2}")
-    svgBase = SVGElement.getDefaultContainer(viewBox)
-
-    # as we iterate over the horizontal rows of nodes, we store some data about the
-    # previous row to help us out
-    prevSpacing = None
-    prevYCenter = None
-    # this stores an array of boolean values describing whether each node from the
-    # previous row was drawn or not. obviously, we initialize it to all False
-    prevDrawnNodes = [False] * tree.getMaxNodeCountByLevel(numLevels+1)
-    # we build the tree from the bottom up so that we can space the bottom row of
-    # nodes the minimum distance apart and then space each node in each row above it
-    # halfway between their two child nodes.
-    # if we are adding blank external nodes, we need an extra level (which will be
-    # filled with Nones)
-    for level in range(numLevels, 0, -1):
-        nodes = tree.getNodesByLevel(level)
-        nodes += [None] * (tree.getMaxNodeCountByLevel(level) - len(nodes))
-        rowCenterY = (level - 1) * NODE_DIAMETER + (level - 1) * NODE_Y_SPACING
-        rowWidth = finalWidth - (NODE_DIAMETER * (numLevels - level))
-        nodeCentersSpan = rowWidth - NODE_DIAMETER
-        if prevSpacing is None:
-            nodeXSpacing = [0] + [
-                nodeCentersSpan * (x / (len(nodes) - 1))
-                for x in range(1,
-                               len(nodes) - 1)
-            ] + [nodeCentersSpan]
+                        addWhiteBG: bool = False,
+                        compact: bool = False,
+                        withIds: bool = False,
+                        palette: Optional[dict] = None):
+    """Produces an SVG that visualizes the tree, which can be a ListBasedBinaryTree
+    or a SparseBinaryTree from one of the parsers in tree.py. For simplicity, the
+    root node is placed at the origin of the SVG's coordinate system and the viewBox
+    is built around that. If addBlankExternalNodes is True, then no existing nodes
+    will be drawn external, but each of them will be given a placeholder external
+    left and right child, if necessary. If compact is True, subtrees are packed
+    together horizontally instead of being spaced as if the tree were complete; see
+    layoutBinaryTree. For withIds, see drawTreeLayout. Nodes are made big enough for
+    the widest label, and labels can start with the color markers of palette; see
+    styles.LabelTable."""
+    labels = LabelTable.fromLabels(tree.getLabels(), palette)
+    layout = layoutBinaryTree(tree, addBlankExternalNodes, compact,
+                              nodeRadius=labels.nodeRadius)
+    return drawTreeLayout(layout, makeBlankExternalNodesBlack, addWhiteBG, withIds,
+                          labels)
+
+
+def drawTreeLayout(layout: TreeLayout,
+                   makeBlankExternalNodesBlack: bool = True,
+                   addWhiteBG: bool = False,
+                   withIds: bool = False,
+                   labels: Optional[LabelTable] = None) -> SVGElement:
+    """Turns a laid out tree into an SVG, styling its nodes with labels, which has
+    to hold every label in the layout (by default, it is made from them with the
+    default palette). If withIds is True, every shape gets an id that stays the same
+    from one version of the tree to the next: "n" followed by the list index of its
+    node for circles and squares, "t" and the index for labels, and "e" and the
+    index of the child at the bottom for edges. The groups that hold them get the
+    ids in SHAPE_GROUP_IDS (and the background gets "bg"), and are kept even when
+    they are empty, so that shapes can be patched into them; see incremental.py."""
+    svgBase = SVGElement.getDefaultContainer(layout.viewBox)
+    # styling that every shape shares is set once on the group that holds them,
+    # and each shape only records what is unique to it; fills are left out when
+    # they match the group's default
+    outline = {"stroke": "black", "stroke-width": NODE_OUTLINE_WIDTH}
+    lines = SVGShapeGroup(
+        "line", ("x1", "y1", "x2", "y2", "stroke-dasharray"), dict(outline))
+    circles = SVGShapeGroup(
+        "circle", ("cx", "cy", "fill", "stroke-dasharray"),
+        {"fill": "white"} | outline, {"r": layout.nodeRadius})
+    squares = SVGShapeGroup(
+        "rect", ("x", "y", "fill", "stroke-dasharray"),
+        {"fill": "white"} | outline,
+        {"width": layout.nodeRadius * 2, "height": layout.nodeRadius * 2})
+    texts = SVGShapeGroup(
+        "text", ("x", "y", "fill"), {
+            "font-size": NODE_TEXT_SIZE,
+            "fill": "black",
+            "text-anchor": "middle",
+            "font-family": NODE_FONT_FAMILY
+        }, {"dominant-baseline": "middle"}, hasText=True)
+
+    if labels is None:
+        labels = LabelTable.fromLabels(layout.nodeLabels)
+    entries = labels.entries
+    styles = labels.styles
+    radius = layout.nodeRadius
+    blankSquareFill = "black" if makeBlankExternalNodesBlack else None
+    dashArray = str(DASH_LENGTH)
+    for i in range(layout.nodeCount):
+        nodeCenterX = layout.nodeXs[i]
+        rowCenterY = layout.nodeYs[i]
+        dashMode = dashArray if layout.nodeIsDashed[i] else None
+        styleId, text = entries[layout.nodeLabels[i]]
+        shapeFill, textFill = styles[styleId]
+        if not layout.nodeIsSquare[i]:
+            circles.addShape(nodeCenterX, rowCenterY, shapeFill, dashMode)
         else:
-            nodeXSpacing = []
-            for i in range(0, len(prevSpacing), 2):
-                nodeXSpacing.append((prevSpacing[i] + prevSpacing[i + 1]) / 2)
-        currentDrawnNodes = []
-        for i in range(len(nodes)):
-            leftChildWasDrawn = prevDrawnNodes[i*2]
-            rightChildWasDrawn = prevDrawnNodes[i*2+1]
-            # this might be different from Actually being external if we drew
-            # placeholder blank children for this node
-            effectivelyExternal = not (leftChildWasDrawn or rightChildWasDrawn)
-            if nodes[i] is None:
-                # we still draw blank nodes if we're adding blank external node
-                # children or we need to add ghostly representations of parents that
-                # "should" exist
-                if effectivelyExternal:
-                    # ^ if a node does have children, we should draw it
-                    if not addBlankExternalNodes or (not tree.hasParent(level, i+1)):
-                        # ^ if we're not drawing blank external nodes, or if the
-                        # current node has no "real" node parents to draw blank
-                        # children for, we skip this one
-                        currentDrawnNodes.append(False)
-                        continue
-            currentDrawnNodes.append(True)
-            squareMode = effectivelyExternal
-            # blank nodes that Should exist because they have children will be
-            # represented as dashed-line ghosts
-            dashMode = {
-                "stroke-dasharray": "4"} if (nodes[i] is None and not effectivelyExternal) else {}
-            nodeCenterX = lowestCenterX + nodeXSpacing[i]
-            # note that the tree class assumes that node numbers start at 1, whereas
-            # in this loop we are coding with them starting at 0, so we have to add 1
-            if nodes[i] is not None and nodes[i].startswith("$red"):
-                shape_fill = "red"
-                text_fill = "black"
-                nodes[i] = nodes[i].replace("$red", "").strip()
-            elif nodes[i] is not None and nodes[i].startswith("$black"):
-                shape_fill = "black"
-                text_fill = "white"
-                nodes[i] = nodes[i].replace("$black", "").strip()
-            else:
-                shape_fill = "white"
-                text_fill = "black"
-            if not squareMode:
-                svgBase.addChild(
-                    SVGElement(
-                        "circle", {
-                            "cx": nodeCenterX,
-                            "cy": rowCenterY,
-                            "r": NODE_RADIUS,
-                            "fill": shape_fill,
-                            "stroke": "black",
-                            "stroke-width": NODE_OUTLINE_WIDTH
-                        } | dashMode))
-            else:
-                svgBase.addChild(
-                    SVGElement(
-                        "rect", {
-                            "width": NODE_DIAMETER,
-                            "height": NODE_DIAMETER,
-                            "x": nodeCenterX - NODE_RADIUS,
-                            "y": rowCenterY - NODE_RADIUS,
-                            "fill": ("black"
-                                     if (nodes[i] is None and makeBlankExternalNodesBlack)
-                                     else shape_fill),
-                            "stroke": "black",
-                            "stroke-width": NODE_OUTLINE_WIDTH
-                        } | dashMode))
-            if nodes[i] is not None:
-                svgBase.addChild(
-                    SVGElement(
-                        "text", {
-                            "x": nodeCenterX,
-                            "y": rowCenterY,
-                            "font-size": NODE_TEXT_SIZE,
-                            "fill": text_fill,
-                            "text-anchor": "middle",
-                            "dominant-baseline": "middle",
-                            "font-family": "LiberationSans, sans-serif"
-                        }, [nodes[i]]))
-            if level != numLevels:
-                if leftChildWasDrawn:
-                    leftChildXPos = lowestCenterX + prevSpacing[i * 2]
-                    svgBase.addChild(
-                        SVGElement(
-                            "line", {
-                                "x1": nodeCenterX,
-                                "y1": rowCenterY,
-                                "x2": leftChildXPos,
-                                "y2": prevYCenter,
-                                "stroke": "black",
-                                "stroke-width": NODE_OUTLINE_WIDTH
-                            } | dashMode))
-                if rightChildWasDrawn:
-                    rightChildXPos = lowestCenterX + prevSpacing[i * 2 + 1]
-                    svgBase.addChild(
-                        SVGElement(
-                            "line", {
-                                "x1": nodeCenterX,
-                                "y1": rowCenterY,
-                                "x2": rightChildXPos,
-                                "y2": prevYCenter,
-                                "stroke": "black",
-                                "stroke-width": NODE_OUTLINE_WIDTH
-                            } | dashMode))
-
-        prevYCenter = rowCenterY
-        prevSpacing = nodeXSpacing
-        prevDrawnNodes = currentDrawnNodes
-    viewBoxComps = svgBase.attrs["viewBox"].split()
-    bg = [
-        SVGElement(
-            "rect",
-            {"fill": "white", "x": viewBoxComps[0],
-             "y": viewBoxComps[1],
-             "width": viewBoxComps[2],
-             "height": viewBoxComps[3]})] if addWhiteBG else []
-    # sort the SVGElements so that the lines are first and thus are covered up by the
-    # shapes and things. also the background is even before them
-    svgBase.children = bg + [x for x in svgBase.children if x.tagName == "line"
-                             ] + [x for x in svgBase.children if x.tagName != "line"]
+            if text is None:
+                shapeFill = blankSquareFill
+            squares.addShape(nodeCenterX - radius, rowCenterY - radius, shapeFill,
+                             dashMode)
+        if text is not None:
+            texts.addShape(nodeCenterX, rowCenterY, textFill, text)
+
+    lines.addShapes(layout.edgeX1s, layout.edgeY1s, layout.edgeX2s,
+                    layout.edgeY2s,
+                    [dashArray if d else None for d in layout.edgeIsDashed]
+                    if any(layout.edgeIsDashed) else None)
+
+    if withIds:
+        # this is done after the fact so that drawing without ids doesn't pay for
+        # them
+        nodes = list(zip(layout.nodeIndices, layout.nodeIsSquare, layout.nodeLabels))
+        addIds(lines, "e", layout.edgeChildIndices)
+        addIds(circles, "n", [i for i, square, _ in nodes if not square])
+        addIds(squares, "n", [i for i, square, _ in nodes if square])
+        addIds(texts, "t", [i for i, _, label in nodes if label is not None])
+
+    if addWhiteBG:
+        svgBase.addChild(
+            SVGElement(
+                "rect",
+                {"fill": "white", "x": layout.minX,
+                 "y": layout.minY,
+                 "width": layout.width,
+                 "height": layout.height} | ({"id": "bg"} if withIds else {})))
+    # the lines go first so that they are covered up by the shapes and things. also
+    # the background is even before them
+    for group, groupId in zip((lines, circles, squares, texts), SHAPE_GROUP_IDS):
+        if withIds:
+            group.attrs["id"] = groupId
+            svgBase.addChild(group)
+        elif len(group) > 0:
+            svgBase.addChild(group)
     return svgBase
 
 
+def addIds(group: SVGShapeGroup, prefix: str, indices: list):
+    """Puts an id made from prefix and the matching index at the front of each of
+    the group's shapes."""
+    group.childAttrNames = ("id",) + group.childAttrNames
+    group.rows = [(prefix + str(i),) + row for i, row in zip(indices, group.rows)]
+
+
+def visualizeTreeSpec(spec: dict) -> SVGElement:
+    """Visualizes a tree described by a dict like the ones the server accepts:
+    "elements" is the list representation of the tree (or the tree is given in one
+    of the compact formats that tree.parseCompactTree reads), and the optional
+    "squares", "squaresBlack", "bg", "compact" and "palette" keys correspond to
+    addBlankExternalNodes, makeBlankExternalNodesBlack, addWhiteBG, compact and
+    palette (see styles.normalizePalette). Labels are stripped of whitespace and
+    blank ones leave out their nodes, like rendering.normalizeTreeSpec does, but
+    they aren't cut short."""
+    tree = parseCompactTree(spec)
+    if tree is None:
+        tree = ListBasedBinaryTree([cleanLabel(x) for x in spec["elements"]])
+    else:
+        tree = SparseBinaryTree({index: cleanLabel(label)
+                                 for index, label in tree.nodes.items()})
+    palette = spec.get("palette")
+    return visualizeBinaryTree(tree,
+                               spec.get("squares", False),
+                               spec.get("squaresBlack", True),
+                               spec.get("bg", False),
+                               spec.get("compact", False),
+                               palette=None if palette is None else
+                               normalizePalette(palette))
+
+
+def tryToVisualizeTreeSpec(spec: dict):
+    try:
+        return visualizeTreeSpec(spec)
+    except Exception as e:
+        return e
+
+
+def visualizeBinaryTrees(specs: list, processes: Optional[int] = None) -> list:
+    """Visualizes many trees, described by specs like the ones visualizeTreeSpec
+    takes, spread across a pool of processes (one per core by default, or none if
+    processes is 1). The results are in the same order as the specs; if a tree
+    couldn't be drawn, its result is the exception that was raised instead of an
+    SVGElement, so that one bad spec doesn't spoil the rest."""
+    if processes == 1 or len(specs) < 2:
+        return [tryToVisualizeTreeSpec(spec) for spec in specs]
+    workers = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(tryToVisualizeTreeSpec, specs,
+                                 chunksize=max(1, len(specs) // (workers * 4))))
+
+
 if __name__ == "__main__":
-    testResult = visualizeBinaryTree(ListBasedBinaryTree(list(range(1, 7))),
+    testResult = visualizeBinaryTree(ListBasedBinaryTree([str(x) for x in range(1, 7)]),
                                      True)
     with open("test.svg", "w+") as testFile:
         testFile.write(testResult.render())
+    batchResults = visualizeBinaryTrees(
+        [{"elements": ["a", "b"]}, {"elements": [1]}, {"brackets": "c(,d)"}], 2)
+    assert type(batchResults[0]) is SVGElement and type(
+        batchResults[2]) is SVGElement, "good specs should be drawn"
+    assert isinstance(batchResults[1], Exception), \
+        "bad specs should give back their exception"
+    from rendering import normalizeTreeSpec, optionsToSVG
+    spec = {"elements": ["a", " ", " c ", ""], "squares": True, "bg": False}
+    assert visualizeTreeSpec(spec).render() == optionsToSVG(
+        normalizeTreeSpec(spec)).render(), \
+        "specs should be drawn like the server draws them"
@@ -0,0 +1,33 @@
+"""Compares the time that the plain Python layout pass and the NumPy-vectorized one
+in layout.py take on big trees, both full ones and ones with a lot of holes. Run it
+from the root of the repository with `python -m benchmarks.layout`."""
+import time
+from layout import layoutBinaryTree
+from tree import ListBasedBinaryTree
+
+TREE_SIZES = [10**4, 10**5, 10**6]
+
+
+def measure(function, *args, repeats=3) -> float:
+    """Returns the fastest time in seconds that a call took out of a few."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    print(f"{'nodes':>8} {'tree':<7} {'blanks':<7} {'python s':>9} {'numpy s':>9} "
+          f"{'speedup':>8}")
+    for size in TREE_SIZES:
+        trees = [("full", ListBasedBinaryTree([str(x) for x in range(size)])),
+                 ("sparse", ListBasedBinaryTree(
+                     [None if x % 3 == 1 else str(x) for x in range(size)]))]
+        for name, tree in trees:
+            for addBlank in (False, True):
+                plain = measure(layoutBinaryTree, tree, addBlank, False, False)
+                vectorized = measure(layoutBinaryTree, tree, addBlank, False, True)
+                print(f"{size:>8} {name:<7} {str(addBlank):<7} {plain:>9.4f} "
+                      f"{vectorized:>9.4f} {plain / vectorized:>7.1f}x")
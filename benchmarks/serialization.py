@@ -0,0 +1,62 @@
+"""Compares the time and peak memory of the old recursive string-building SVG
+renderer against the streaming serializer in svg.py. Run it from the root of the
+repository with `python -m benchmarks.serialization`."""
+import time
+import tracemalloc
+from artist import visualizeBinaryTree
+from svg import SVGElement, SVGShapeGroup, isElement
+from tree import ListBasedBinaryTree
+
+TREE_SIZES = [10**3, 10**4, 10**5]
+
+
+def legacyRender(element: SVGElement, depth=0) -> str:
+    """The way SVGElement.render used to work, where every element builds its whole
+    subtree as a string and the parent copies it again."""
+    if type(element) is SVGShapeGroup:
+        element = SVGElement("g", element.attrs, element.children)
+    tabBase = "    "
+    tab = tabBase * depth
+    renderedChildren = "\n".join(
+        (legacyRender(c, depth + 1) if isElement(c) else tabBase *
+         (depth + 1) + c) for c in element.children)
+    renderedAttrs = " ".join(k + f'="{v}"' for k, v in element.attrs.items())
+    return tab + f"<{element.tagName} " + renderedAttrs + (
+        "/>" if len(element.children) == 0 else
+        (">\n" + renderedChildren + f"\n{tab}</{element.tagName}>"))
+
+
+def streamToNowhere(svg: SVGElement, compact: bool) -> int:
+    """Consumes the chunks like a socket would, keeping only a byte count."""
+    return sum(len(c) for c in svg.iterChunks(compact=compact))
+
+
+def measure(function, *args):
+    """Returns the time in seconds and the peak traced memory in bytes that a call
+    takes. They are measured in separate calls, since tracing allocations slows
+    everything down."""
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    approaches = [
+        ("legacy render", lambda svg: legacyRender(svg)),
+        ("render()", lambda svg: svg.render()),
+        ("render(compact=True)", lambda svg: svg.render(compact=True)),
+        ("streamed chunks", lambda svg: streamToNowhere(svg, False)),
+        ("streamed compact chunks", lambda svg: streamToNowhere(svg, True)),
+    ]
+    print(f"{'nodes':>8} {'approach':<25} {'seconds':>9} {'peak MiB':>9}")
+    for size in TREE_SIZES:
+        svg = visualizeBinaryTree(
+            ListBasedBinaryTree([str(x) for x in range(size)]), True)
+        for name, approach in approaches:
+            elapsed, peak = measure(approach, svg)
+            print(f"{size:>8} {name:<25} {elapsed:>9.4f} {peak / 2**20:>9.2f}")
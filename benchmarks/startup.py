@@ -0,0 +1,125 @@
+"""Measures how quickly the server gets going: how long its modules take to import
+in a fresh interpreter, and, for a server started with and without warming up, how
+long it takes to answer its first request and how long its first and second PNGs
+take. Run it from the root of the repository with `python -m benchmarks.startup`.
+
+Every measurement is made in new processes, since the point is what a process pays
+before anything has been loaded."""
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the modules whose import times are measured, from the server down to the
+# rasterizers that it only loads for PNGs
+MODULES = ["server", "rendering", "raster", "cairosvg"]
+IMPORT_RUNS = 5
+SERVER_RUNS = 3
+# how long to wait for a server to answer before giving up on it
+SERVER_TIMEOUT = 60
+SPEC = json.dumps({"elements": [str(i) for i in range(1, 32)], "squares": True,
+                   "bg": False}).encode("utf-8")
+
+
+def measureImport(module: str) -> list:
+    """Returns the times that importing module took in IMPORT_RUNS fresh
+    interpreters, or raises a RuntimeError if it couldn't be imported."""
+    times = []
+    for _ in range(IMPORT_RUNS):
+        result = subprocess.run(
+            [sys.executable, "-c",
+             "import time; start = time.perf_counter(); import " + module +
+             "; print(time.perf_counter() - start)"],
+            cwd=ROOT, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        times.append(float(result.stdout))
+    return times
+
+
+def getUnusedPort() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def post(port: int, path: str) -> tuple:
+    """Sends the sample spec and returns the status of the response and how long it
+    took to arrive, in seconds."""
+    start = time.perf_counter()
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", SPEC)
+    try:
+        with urllib.request.urlopen(request, timeout=SERVER_TIMEOUT) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - start
+
+
+def measureServer(warmUp: bool, renderProcesses: int) -> dict:
+    """Starts a server and returns the seconds from starting it to its first
+    answered /svg request ("ready"), and the durations of its first and second /png
+    requests, with their statuses."""
+    port = getUnusedPort()
+    arguments = [sys.executable, os.path.join(ROOT, "server.py"),
+                 "--address", "127.0.0.1", "--port", str(port),
+                 "--render-processes", str(renderProcesses), "--cache-entries", "0"]
+    if not warmUp:
+        arguments.append("--no-warm-up")
+    # the server logs to the directory that it is run in
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        process = subprocess.Popen(arguments, cwd=directory,
+                                   stdout=subprocess.DEVNULL)
+        try:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError("the server exited")
+                if time.perf_counter() - start > SERVER_TIMEOUT:
+                    raise RuntimeError("the server didn't answer")
+                try:
+                    post(port, "/svg")
+                    break
+                except OSError:
+                    time.sleep(0.01)
+            ready = time.perf_counter() - start
+            firstStatus, first = post(port, "/png")
+            secondStatus, second = post(port, "/png")
+        finally:
+            process.terminate()
+            process.wait()
+    return {"ready": ready, "firstPNG": first, "secondPNG": second,
+            "statuses": (firstStatus, secondStatus)}
+
+
+if __name__ == "__main__":
+    print(f"{'import':<12} {'best s':>8} {'median s':>9}")
+    for module in MODULES:
+        try:
+            times = measureImport(module)
+        except RuntimeError as e:
+            print(f"{module:<12} skipped: {e}")
+            continue
+        print(f"{module:<12} {min(times):>8.4f} {statistics.median(times):>9.4f}")
+    print()
+    print(f"{'server':<24} {'ready s':>8} {'1st png s':>10} {'2nd png s':>10} "
+          f"statuses")
+    for warmUp in (False, True):
+        for renderProcesses in (0, 1):
+            name = (("warm" if warmUp else "cold") +
+                    (", in pool" if renderProcesses else ", in process"))
+            runs = [measureServer(warmUp, renderProcesses)
+                    for _ in range(SERVER_RUNS)]
+            print(f"{name:<24} "
+                  f"{statistics.median(r['ready'] for r in runs):>8.3f} "
+                  f"{statistics.median(r['firstPNG'] for r in runs):>10.4f} "
+                  f"{statistics.median(r['secondPNG'] for r in runs):>10.4f} "
+                  f"{runs[-1]['statuses']}")
@@ -0,0 +1,314 @@
+"""Times every stage of drawing a tree on a fixed set of workloads, so that changes
+can be checked for speedups and regressions. Run it from the root of the
+repository with `python -m benchmarks.suite`; `--help` lists the options.
+
+The stages are tree queries on ListBasedBinaryTree, parsing the tree from bracket
+notation, layout (plain and compact), drawing the laid out tree into SVG
+elements, serializing them, rasterizing them with CairoSVG, rasterizing the
+layout straight away with cairo, and whole /svg and /png requests to the server.
+The workloads are complete trees, sparse trees with random holes, skewed trees
+that are one long spine, and complete trees full of long, colored labels, each at
+growing sizes (measured in slots of the list representation). Stages whose
+dependencies aren't installed are skipped.
+
+Each case is reported with its best and median time, the peak memory that it
+traced while running, and the memory that was still held by what it returned.
+Results can be saved as a JSON baseline and compared against later, and any case
+that got slower or bigger by more than the threshold is flagged."""
+import argparse
+import asyncio
+import cProfile
+import json
+import platform
+import pstats
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Optional
+from artist import visualizeBinaryTree
+from layout import layoutBinaryTree
+from tree import ListBasedBinaryTree, parseBracketString
+
+SIZES = [10**2, 10**3, 10**4]
+# PNGs take much longer than everything else, so they stop at smaller trees
+MAX_PNG_SIZE = 10**3
+# cases are run until they have taken this many seconds, and at least MIN_RUNS times
+MIN_SECONDS = 0.2
+MIN_RUNS = 3
+MAX_RUNS = 100
+# by default, a case has regressed if it got this much slower or bigger
+REGRESSION_THRESHOLD = 0.2
+
+
+def makeComplete(size: int) -> list:
+    return [str(i) for i in range(size)]
+
+
+def makeSparse(size: int) -> list:
+    """About a third of the slots are filled, at random but the same every time."""
+    generator = random.Random(size)
+    return [str(i) if generator.random() < 0.35 else None for i in range(size)]
+
+
+def makeSkewed(size: int) -> list:
+    """A right spine as deep as fits in size slots, with a leaf hanging off the
+    left of each spine node; the list is mostly empty."""
+    elements = [None] * size
+    index = 0
+    while index < size:
+        elements[index] = "s" + str(index)
+        if index * 2 + 1 < size:
+            elements[index * 2 + 1] = "l" + str(index)
+        index = index * 2 + 2
+    return elements
+
+
+def makeLabelHeavy(size: int) -> list:
+    """Every node has a ten-character label, and most are colored."""
+    prefixes = ("$red ", "$black ", "")
+    return [prefixes[i % 3] + format(i, "010d")[-10:] for i in range(size)]
+
+
+WORKLOADS = {"complete": makeComplete, "sparse": makeSparse,
+             "skewed": makeSkewed, "labels": makeLabelHeavy}
+
+
+def toBrackets(elements: list, index: int = 0) -> str:
+    """Writes the tree out in the bracket notation that parseBracketString reads."""
+    if index >= len(elements):
+        return ""
+    left = toBrackets(elements, index * 2 + 1)
+    right = toBrackets(elements, index * 2 + 2)
+    label = elements[index] or ""
+    return label + ("(" + left + "," + right + ")" if left or right else "")
+
+
+def queryTree(tree: ListBasedBinaryTree) -> int:
+    """Uses every kind of query that ListBasedBinaryTree answers."""
+    count = 0
+    for level, view in enumerate(tree.getLevelViews(), 1):
+        tree.getLevelBitmap(level)
+        tree.getChildBitmaps(level)
+        for number, node in enumerate(view, 1):
+            if node is not None:
+                count += tree.isNodeExternal(level, number)
+                count += tree.hasParent(level, number)
+    count += sum(1 for _ in tree.getExistingIndices())
+    return count
+
+
+def loadCairoSVG() -> Optional[str]:
+    """Returns why PNGs can't be made here, or None if they can."""
+    try:
+        import cairosvg  # noqa: F401
+    except Exception as e:
+        return f"CairoSVG is not usable ({e.__class__.__name__})"
+    return None
+
+
+class HTTPClient:
+    """Runs the server on an unused local port with an event loop of its own, and
+    sends it requests one at a time."""
+
+    def __init__(self):
+        import server
+        import tornado.httpclient
+        import tornado.httpserver
+        import tornado.testing
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        from limits import TreeLimits
+        socket, self.port = tornado.testing.bind_unused_port()
+        # the trees in here can be bigger than the server normally takes
+        limits = TreeLimits(maxBodyBytes=2**30, maxNodes=2**30, maxHeight=30,
+                            maxPNGPixels=2**40)
+        self.server = tornado.httpserver.HTTPServer(
+            server.makeApplication(tree_limits=limits), max_body_size=2**30)
+        self.server.add_sockets([socket])
+        self.client = tornado.httpclient.AsyncHTTPClient()
+
+    def post(self, path: str, body: bytes) -> bytes:
+        response = self.loop.run_until_complete(self.client.fetch(
+            f"http://127.0.0.1:{self.port}{path}", method="POST", body=body))
+        return response.body
+
+    def close(self):
+        self.server.stop()
+        self.client.close()
+        self.loop.close()
+
+
+def getCases(sizes: list, client: Optional[HTTPClient],
+             pngProblem: Optional[str]) -> list:
+    """Returns (name, function, argument) tuples for every case, where function is
+    what gets timed; arguments are built ahead of time so that building them isn't
+    part of the measurement. Skipped cases have a string explaining why in place
+    of a function."""
+    cases = []
+    for workloadName, makeElements in WORKLOADS.items():
+        for size in sizes:
+            elements = makeElements(size)
+            tree = ListBasedBinaryTree(elements)
+            svg = visualizeBinaryTree(tree, True)
+            spec = json.dumps({"elements": [x or "" for x in elements],
+                               "squares": True, "bg": False}).encode("utf-8")
+            suffix = f"/{workloadName}/{size}"
+            cases += [
+                ("tree" + suffix, queryTree, tree),
+                ("parse-brackets" + suffix, parseBracketString,
+                 toBrackets(elements)),
+                ("layout" + suffix, lambda t: layoutBinaryTree(t, True), tree),
+                ("layout-compact" + suffix,
+                 lambda t: layoutBinaryTree(t, True, True), tree),
+                ("draw" + suffix, lambda t: visualizeBinaryTree(t, True), tree),
+                ("render" + suffix, lambda s: s.render(), svg),
+                ("render-chunks" + suffix,
+                 lambda s: sum(len(c) for c in s.iterChunks(compact=True)), svg),
+            ]
+            if client is None:
+                cases.append(("http-svg" + suffix, "the server can't be loaded",
+                              None))
+            else:
+                cases.append(("http-svg" + suffix,
+                              lambda b: client.post("/svg", b), spec))
+            if size > MAX_PNG_SIZE:
+                continue
+            if pngProblem is not None:
+                cases += [("png" + suffix, pngProblem, None),
+                          ("png-direct" + suffix, pngProblem, None),
+                          ("http-png" + suffix, pngProblem, None)]
+            else:
+                from rendering import PNG_SCALE, svgToPNG
+                from raster import layoutToPNG
+                layout = layoutBinaryTree(tree, True)
+                cases += [("png" + suffix, svgToPNG, svg),
+                          ("png-direct" + suffix,
+                           lambda l: layoutToPNG(l, True, False, PNG_SCALE),
+                           layout)]
+                if client is None:
+                    cases.append(("http-png" + suffix,
+                                  "the server can't be loaded", None))
+                else:
+                    cases.append(("http-png" + suffix,
+                                  lambda b: client.post("/png", b), spec))
+    return cases
+
+
+def measure(function: Callable, argument) -> dict:
+    """Runs function(argument) until MIN_SECONDS have passed (within the limits of
+    MIN_RUNS and MAX_RUNS), then once more while tracing allocations, which slows
+    everything down too much to be timed."""
+    times = []
+    start = time.perf_counter()
+    while len(times) < MAX_RUNS and (
+            len(times) < MIN_RUNS or time.perf_counter() - start < MIN_SECONDS):
+        runStart = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - runStart)
+    tracemalloc.start()
+    result = function(argument)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {"seconds": min(times), "medianSeconds": statistics.median(times),
+            "runs": len(times), "peakBytes": peak, "retainedBytes": retained}
+
+
+def findRegressions(results: dict, baseline: dict, threshold: float) -> list:
+    """Compares the best times and peak memory of cases that are in both results
+    and baseline, and describes the ones that got worse by more than threshold (as
+    a fraction)."""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for key in ("seconds", "peakBytes"):
+            if old[key] > 0 and result[key] > old[key] * (1 + threshold):
+                regressions.append(
+                    f"{name}: {key} went from {old[key]:.6g} to {result[key]:.6g} "
+                    f"(+{(result[key] / old[key] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def parseArguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="sizes of the trees, in slots")
+    parser.add_argument("--filter", default="",
+                        help="only run cases whose names contain this, like "
+                        "layout/ or /sparse/")
+    parser.add_argument("--save", metavar="PATH",
+                        help="save the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="flag regressions against a saved baseline, and exit "
+                        "with status 1 if there are any")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="fraction that a case has to get worse by to be "
+                        "flagged")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the cases instead of timing them, and print "
+                        "the functions they spent the most time in")
+    return parser.parse_args()
+
+
+def main() -> int:
+    arguments = parseArguments()
+    pngProblem = loadCairoSVG()
+    try:
+        client = HTTPClient()
+    except Exception as e:
+        print(f"can't run the server ({e.__class__.__name__}: "
+              f"{str(e).splitlines()[0] if str(e) else ''})", file=sys.stderr)
+        client = None
+    cases = [case for case in getCases(arguments.sizes, client, pngProblem)
+             if arguments.filter in case[0]]
+
+    if arguments.profile:
+        profiler = cProfile.Profile()
+        for name, function, argument in cases:
+            if not isinstance(function, str):
+                profiler.runcall(function, argument)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+        if client is not None:
+            client.close()
+        return 0
+
+    results = {}
+    print(f"{'case':<32} {'best s':>10} {'median s':>10} {'runs':>5} "
+          f"{'peak MiB':>9} {'kept MiB':>9}")
+    for name, function, argument in cases:
+        if isinstance(function, str):
+            print(f"{name:<32} skipped: {function}")
+            continue
+        result = measure(function, argument)
+        results[name] = result
+        print(f"{name:<32} {result['seconds']:>10.6f} "
+              f"{result['medianSeconds']:>10.6f} {result['runs']:>5} "
+              f"{result['peakBytes'] / 2**20:>9.3f} "
+              f"{result['retainedBytes'] / 2**20:>9.3f}")
+    if client is not None:
+        client.close()
+
+    if arguments.save:
+        with open(arguments.save, "w", encoding="utf-8") as file:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "results": results}, file, indent=1, sort_keys=True)
+        print(f"saved baseline to {arguments.save}")
+    if arguments.compare:
+        with open(arguments.compare, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+        regressions = findRegressions(results, baseline, arguments.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        print(f"{len(regressions)} regression(s) against {arguments.compare}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Union
+
+
+class RenderCache:
+    """A least-recently-used cache for rendered responses, keyed by a hash of the
+    request that produced them. It is bounded both by the number of entries and by
+    the total size of the stored bytes. If a directory is given, every entry is also
+    mirrored there as a file named after its key, so that a restarted server starts
+    out with the cache it left off with."""
+
+    def __init__(self,
+                 maxEntries: int = 1000,
+                 maxBytes: int = 64 * 2**20,
+                 directory: Union[str, None] = None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.loadDirectory()
+
+    @staticmethod
+    def getKey(request: dict) -> str:
+        """Returns a key that is the same for any two requests with the same
+        contents, no matter how their JSON was formatted or ordered."""
+        normalized = json.dumps(request, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes):
+        """Stores value under key, evicting the least recently used entries to make
+        room. Values too big to ever fit are not stored."""
+        if len(value) > self.maxBytes or self.maxEntries < 1:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += len(value)
+        while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+            oldKey, oldValue = self.entries.popitem(last=False)
+            self.size -= len(oldValue)
+            self.evictions += 1
+            if self.directory is not None:
+                self.removeFile(oldKey)
+        if self.directory is not None:
+            self.writeFile(key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.size,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+    def getPath(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def writeFile(self, key: str, value: bytes):
+        # writing to a temporary file first means a crash can't leave a truncated
+        # entry behind; it is named after this process in case other server
+        # processes share the directory
+        path = self.getPath(key)
+        temporaryPath = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temporaryPath, "wb") as file:
+                file.write(value)
+            os.replace(temporaryPath, path)
+        except OSError:
+            logging.exception("could not write cache entry to " + path)
+
+    def removeFile(self, key: str):
+        try:
+            os.remove(self.getPath(key))
+        except OSError:
+            pass
+
+    def loadDirectory(self):
+        """Loads the entries that a previous run left in the directory, from least
+        to most recently written, so the newest ones survive if they don't all
+        fit."""
+        names = [name for name in os.listdir(self.directory)
+                 if len(name) == 64 and not name.endswith(".tmp")]
+        names.sort(key=lambda name: os.path.getmtime(self.getPath(name)))
+        for name in names:
+            try:
+                with open(self.getPath(name), "rb") as file:
+                    value = file.read()
+            except OSError:
+                continue
+            self.entries[name] = value
+            self.size += len(value)
+            while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+                oldKey, oldValue = self.entries.popitem(last=False)
+                self.size -= len(oldValue)
+                self.removeFile(oldKey)
+
+
+if __name__ == "__main__":
+    import tempfile
+    assert RenderCache.getKey({"a": 1, "b": [2]}) == RenderCache.getKey(
+        {"b": [2], "a": 1}), "keys should not depend on dict order"
+    test = RenderCache(maxEntries=2, maxBytes=10)
+    test.put("a", b"1234")
+    test.put("b", b"5678")
+    assert test.get("a") == b"1234", "entry should be cached"
+    test.put("c", b"9")
+    assert "b" not in test, "least recently used entry should be evicted"
+    test.put("d", b"0123456789")
+    assert len(test) == 1, "entries should be evicted to stay under maxBytes"
+    assert test.stats["hits"] == 1
+    with tempfile.TemporaryDirectory() as directory:
+        key = RenderCache.getKey("persisted")
+        RenderCache(directory=directory).put(key, b"value")
+        assert RenderCache(directory=directory).get(key) == b"value", \
+            "entries should survive in the cache directory"
+    print("tests passed")
@@ -0,0 +1,197 @@
+"""Draws trees from files without running the server. Each input file holds tree
+specs like the ones the server accepts, in one of these formats:
+
+- JSON: a single spec, or a list of them
+- NDJSON: one spec per line
+- CSV: one tree per row, where the cells are the element labels in list
+  representation order (empty cells are missing nodes), just like the frontend's
+  text box
+
+Options that a spec leaves out (and every option, for CSV rows) are taken from the
+command line. A spec can also have a "name", which is used for its output file;
+otherwise, output files are named after their input file and position in it (like
+trees.csv-0.svg). The hash of every drawn tree is remembered in the output
+directory, so trees whose output is already up to date are skipped the next time
+around."""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+from rendering import (getCacheKey, normalizeTreeSpec, optionsToPNG, optionsToSVG,
+                       svgToPNG)
+
+# the file in the output directory that maps output file names to the hashes of
+# the trees that are drawn in them
+HASHES_FILE_NAME = ".treehashes.json"
+
+
+def readSpecs(file: io.TextIOBase, inputFormat: str) -> list:
+    if inputFormat == "json":
+        specs = json.load(file)
+        return specs if type(specs) is list else [specs]
+    elif inputFormat == "ndjson":
+        return [json.loads(line) for line in file if line.strip() != ""]
+    elif inputFormat == "csv":
+        return [{"elements": row} for row in csv.reader(file)]
+    raise ValueError("unknown input format " + inputFormat)
+
+
+def guessInputFormat(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+    elif extension == ".csv":
+        return "csv"
+    return "json"
+
+
+def getOutputName(spec, sourceName: str, index: int) -> str:
+    if type(spec) is dict and type(spec.get("name")) is str:
+        # names shouldn't be able to point outside of the output directory
+        return os.path.basename(spec["name"])
+    return f"{sourceName}-{index}"
+
+
+def renderToFile(job: tuple) -> Union[str, None]:
+    """Draws one tree and writes it out. Returns an error message if that didn't
+    work. This is run in the worker processes."""
+    options, outputFormat, scale, compactMarkup, directPNG, path = job
+    try:
+        if outputFormat == "png":
+            if directPNG:
+                png = optionsToPNG(options, scale)
+            else:
+                png = svgToPNG(optionsToSVG(options), scale)
+            with open(path, "wb") as file:
+                file.write(png)
+        else:
+            svg = optionsToSVG(options)
+            with open(path, "w", encoding="utf-8") as file:
+                svg.renderTo(file, compact=compactMarkup)
+        return None
+    except Exception as e:
+        return repr(e)
+
+
+def parseArguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+",
+                        help="files to read tree specs from, or - for stdin")
+    parser.add_argument("--input-format", choices=("json", "ndjson", "csv"),
+                        help="format of the inputs (guessed from their extensions "
+                        "by default, and NDJSON for stdin)")
+    parser.add_argument("-o", "--output-dir", default=".")
+    parser.add_argument("-f", "--format", choices=("svg", "png"), default="svg")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="how many processes to draw trees in (defaults to one "
+                        "per core)")
+    parser.add_argument("--scale", type=float, default=2,
+                        help="how much to scale PNGs up by")
+    parser.add_argument("--direct-png", action="store_true",
+                        help="draw PNGs straight from the layout instead of "
+                        "through CairoSVG")
+    parser.add_argument("--minify", action="store_true",
+                        help="leave the indentation out of SVGs")
+    parser.add_argument("--force", action="store_true",
+                        help="draw every tree, even if its output is up to date")
+    parser.add_argument("--squares", action="store_true",
+                        help="add placeholder external nodes")
+    parser.add_argument("--white-squares", action="store_true",
+                        help="don't color placeholder external nodes black")
+    parser.add_argument("--bg", action="store_true",
+                        help="add a white background")
+    parser.add_argument("--compact", action="store_true",
+                        help="pack subtrees tightly together")
+    return parser.parse_args()
+
+
+def main() -> int:
+    arguments = parseArguments()
+    defaults = {"squares": arguments.squares,
+                "squaresBlack": not arguments.white_squares,
+                "bg": arguments.bg, "compact": arguments.compact}
+    os.makedirs(arguments.output_dir, exist_ok=True)
+    hashesPath = os.path.join(arguments.output_dir, HASHES_FILE_NAME)
+    try:
+        with open(hashesPath, encoding="utf-8") as file:
+            hashes = json.load(file)
+    except (OSError, ValueError):
+        hashes = {}
+
+    start = time.perf_counter()
+    jobs = []
+    jobHashes = []
+    skipped = 0
+    failed = 0
+    for inputPath in arguments.inputs:
+        if inputPath == "-":
+            sourceName = "stdin"
+            specs = readSpecs(sys.stdin, arguments.input_format or "ndjson")
+        else:
+            # the extension is kept so that trees.csv and trees.json don't
+            # overwrite each other's output
+            sourceName = os.path.basename(inputPath)
+            with open(inputPath, encoding="utf-8", newline="") as file:
+                specs = readSpecs(
+                    file, arguments.input_format or guessInputFormat(inputPath))
+        for index, spec in enumerate(specs):
+            outputName = (getOutputName(spec, sourceName, index) + "." +
+                          arguments.format)
+            try:
+                options = normalizeTreeSpec(
+                    defaults | spec if type(spec) is dict else spec, None)
+            except ValueError as e:
+                print(f"{sourceName} #{index}: {e}", file=sys.stderr)
+                failed += 1
+                continue
+            # the hash covers everything that goes into the output file, which
+            # for SVGs includes whether the markup is minified
+            treeHash = getCacheKey(
+                options | ({"minify": arguments.minify}
+                           if arguments.format == "svg" else {}),
+                arguments.format, arguments.scale, arguments.direct_png)
+            outputPath = os.path.join(arguments.output_dir, outputName)
+            if (not arguments.force and hashes.get(outputName) == treeHash
+                    and os.path.exists(outputPath)):
+                skipped += 1
+                continue
+            jobs.append((options, arguments.format, arguments.scale,
+                         arguments.minify, arguments.direct_png, outputPath))
+            jobHashes.append((outputName, treeHash))
+
+    if arguments.jobs == 1 or len(jobs) < 2:
+        errors = map(renderToFile, jobs)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(arguments.jobs)
+        workers = arguments.jobs or os.cpu_count() or 1
+        errors = executor.map(renderToFile, jobs,
+                              chunksize=max(1, len(jobs) // (workers * 4)))
+    rendered = 0
+    for (outputName, treeHash), error in zip(jobHashes, errors):
+        if error is None:
+            rendered += 1
+            hashes[outputName] = treeHash
+        else:
+            failed += 1
+            hashes.pop(outputName, None)
+            print(f"{outputName}: {error}", file=sys.stderr)
+    if executor is not None:
+        executor.shutdown()
+    with open(hashesPath, "w", encoding="utf-8") as file:
+        json.dump(hashes, file, indent=1, sort_keys=True)
+
+    elapsed = time.perf_counter() - start
+    print(f"drew {rendered} tree(s), skipped {skipped} up to date, {failed} failed; "
+          f"{elapsed:.2f}s, {rendered / elapsed if elapsed > 0 else 0:.1f} trees/s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+"""Remembers the drawings that clients are looking at, so that when a tree is
+edited, only the shapes that changed need to be sent back instead of the whole
+SVG. Shapes are told apart by the ids that artist.drawTreeLayout gives them, which
+only depend on the slot that a node is in, so a node keeps its id from one version
+of a tree to the next."""
+import json
+from collections import OrderedDict
+from typing import Optional, Union
+from artist import drawTreeLayout
+from cache import RenderCache
+from layout import getAffectedSlots, getNumLevels, layoutBinaryTree, layoutSlots
+from limits import TreeLimits, checkSVGShapes
+from styles import LabelTable
+from svg import SVGElement, SVGShapeGroup
+from tree import BinaryTree, treeFromOptions
+
+# patches that would touch more than this fraction of the shapes in a drawing are
+# not worth it, and the whole drawing is sent instead
+MAX_PATCH_FRACTION = 0.5
+
+
+class Drawing:
+    """What is needed to patch a drawing of a tree: the options it was drawn with,
+    the number of levels, node radius and viewBox that its layout had, the set of
+    slots that were drawn, and a dict mapping the id of each shape to the id of the
+    group it is in and its row of attribute values (see SVGShapeGroup). groups maps
+    each group's id to its child tag name, child attribute names, constant child
+    attributes and whether its children have text."""
+
+    def __init__(self, options: dict, numLevels: int, nodeRadius: float,
+                 viewBox: str, drawnSlots: set, shapes: dict, groups: dict):
+        self.options = options
+        self.numLevels = numLevels
+        self.nodeRadius = nodeRadius
+        self.viewBox = viewBox
+        self.drawnSlots = drawnSlots
+        self.shapes = shapes
+        self.groups = groups
+
+    @classmethod
+    def fromSVG(cls, options: dict, numLevels: int, nodeRadius: float,
+                svg: SVGElement, drawnSlots: set):
+        """Boils down an SVG made by drawTreeLayout with ids."""
+        shapes = {}
+        groups = {}
+        for child in svg.children:
+            if type(child) is SVGShapeGroup:
+                groupId = child.attrs["id"]
+                groups[groupId] = (child.childTagName, child.childAttrNames,
+                                   child.childAttrs, child.hasText)
+                for row in child.rows:
+                    shapes[row[0]] = (groupId, row)
+        return cls(options, numLevels, nodeRadius, svg.attrs["viewBox"],
+                   drawnSlots, shapes, groups)
+
+    @property
+    def width(self) -> float:
+        # the drawing of an empty tree isn't a whole number wide
+        width = float(self.viewBox.split()[2])
+        return int(width) if width.is_integer() else width
+
+    def describeShape(self, shapeId: str, old: Optional[tuple] = None) -> dict:
+        """Describes a shape for a patch. If old is the shape's earlier row, only
+        the attributes that changed are described; otherwise, everything needed to
+        create the shape is. Attributes with None values should be removed."""
+        groupId, row = self.shapes[shapeId]
+        tagName, names, constantAttrs, hasText = self.groups[groupId]
+        description = {"id": shapeId}
+        if old is None:
+            description |= {"group": groupId, "tag": tagName,
+                            "attrs": dict(zip(names[1:], row[1:])) | constantAttrs}
+        else:
+            description["attrs"] = {names[i]: row[i] for i in range(1, len(names))
+                                    if row[i] != old[i]}
+        if hasText and (old is None or old[-1] != row[-1]):
+            description["text"] = row[-1]
+        return description
+
+    def getPatch(self, base, shapeIds) -> dict:
+        """Returns a patch that turns the drawing base into this one, looking only
+        at the shapes with the given ids. A shape that moves from one group to
+        another is removed and added again."""
+        remove = []
+        add = []
+        change = []
+        for shapeId in sorted(shapeIds):
+            before = base.shapes.get(shapeId)
+            after = self.shapes.get(shapeId)
+            if before == after:
+                continue
+            if before is not None and (after is None or before[0] != after[0]):
+                remove.append(shapeId)
+            if after is not None:
+                if before is None or before[0] != after[0]:
+                    add.append(self.describeShape(shapeId))
+                else:
+                    change.append(self.describeShape(shapeId, before[1]))
+        return {"viewBox": self.viewBox, "remove": remove, "add": add,
+                "change": change}
+
+
+def getShapeIds(slots) -> list:
+    """Returns the ids of every shape that could belong to the given slots: their
+    nodes, their labels, and the edges down to their children."""
+    return [prefix + str(i) for slot in slots
+            for prefix, i in (("n", slot), ("t", slot), ("e", slot * 2 + 1),
+                              ("e", slot * 2 + 2))]
+
+
+def getChangedIndices(old: list, new: list) -> list:
+    changed = [i for i, (a, b) in enumerate(zip(old, new)) if a != b]
+    longer = old if len(old) > len(new) else new
+    changed += [i for i in range(min(len(old), len(new)), len(longer))
+                if longer[i] is not None]
+    return changed
+
+
+def getChangedNodeIndices(old: BinaryTree, new: BinaryTree) -> list:
+    """Does what getChangedIndices does for trees that aren't both lists."""
+    indices = set(old.getExistingIndices()) | set(new.getExistingIndices())
+    return [i for i in indices if old.getNodeByIndex(i) != new.getNodeByIndex(i)]
+
+
+def drawTree(options: dict, base: Optional[Drawing] = None) -> tuple:
+    """Draws the tree described by the normalized options (see
+    rendering.normalizeTreeSpec) and returns a Drawing of it, along with either a
+    patch that turns base into it or, if there is no base or a patch wouldn't save
+    much, the whole SVG; whichever one isn't returned is None.
+
+    If the tree is laid out in full, only labels or the existence of nodes
+    changed, and the node radius stayed the same, only the slots of those nodes,
+    their ancestors and (with placeholder external nodes) their children are laid
+    out and drawn again, since nothing else can have moved. Otherwise, the whole
+    tree is drawn again and the patch compares every shape."""
+    tree = treeFromOptions(options)
+    squares = options["squares"]
+    numLevels = getNumLevels(tree, squares)
+    labels = LabelTable.fromLabels(tree.getLabels(), options.get("palette"))
+    nodeRadius = labels.nodeRadius
+    sameStyle = base is not None and all(
+        base.options[k] == options[k]
+        for k in ("squares", "squaresBlack", "bg", "compact")) and \
+        base.options.get("palette") == options.get("palette")
+    if sameStyle and not options["compact"] and numLevels == base.numLevels and \
+            nodeRadius == base.nodeRadius:
+        if "elements" in base.options and "elements" in options:
+            changed = getChangedIndices(base.options["elements"],
+                                        options["elements"])
+        else:
+            changed = getChangedNodeIndices(treeFromOptions(base.options), tree)
+        slots = getAffectedSlots(changed, squares)
+        partial = layoutSlots(tree, squares, slots, base.drawnSlots, nodeRadius)
+        redrawn = Drawing.fromSVG(
+            options, numLevels, nodeRadius,
+            drawTreeLayout(partial, options["squaresBlack"], False, True, labels),
+            set(partial.nodeIndices))
+        shapeIds = getShapeIds(slots)
+        shapes = dict(base.shapes)
+        for shapeId in shapeIds:
+            shapes.pop(shapeId, None)
+        shapes |= redrawn.shapes
+        drawing = Drawing(options, numLevels, nodeRadius, base.viewBox,
+                          (base.drawnSlots - slots) | redrawn.drawnSlots, shapes,
+                          base.groups)
+        patch = drawing.getPatch(base, shapeIds)
+        if isPatchSmall(patch, drawing):
+            return drawing, patch, None
+
+    layout = layoutBinaryTree(tree, squares, options["compact"],
+                              nodeRadius=nodeRadius)
+    svg = drawTreeLayout(layout, options["squaresBlack"], options["bg"], True,
+                         labels)
+    drawing = Drawing.fromSVG(options, numLevels, nodeRadius, svg,
+                              set(layout.nodeIndices))
+    # patches only carry the attributes of shapes, so they can't change the
+    # attributes that every shape in a group shares, like the size of nodes
+    if base is not None and base.options["bg"] == options["bg"] and \
+            base.groups == drawing.groups:
+        patch = drawing.getPatch(base, base.shapes.keys() | drawing.shapes.keys())
+        if isPatchSmall(patch, drawing):
+            return drawing, patch, None
+    return drawing, None, svg
+
+
+def isPatchSmall(patch: dict, drawing: Drawing) -> bool:
+    size = len(patch["remove"]) + len(patch["add"]) + len(patch["change"])
+    return size <= len(drawing.shapes) * MAX_PATCH_FRACTION
+
+
+class DrawingHistory:
+    """The most recently drawn Drawings, keyed by a hash of their options, with the
+    least recently used ones forgotten first."""
+
+    def __init__(self, maxEntries: int = 100):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def getKey(options: dict) -> str:
+        return RenderCache.getKey(options)
+
+    def get(self, key: str) -> Union[Drawing, None]:
+        drawing = self.entries.get(key)
+        if drawing is not None:
+            self.entries.move_to_end(key)
+        return drawing
+
+    def put(self, key: str, drawing: Drawing):
+        if self.maxEntries < 1:
+            return
+        self.entries[key] = drawing
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def renderEditResponse(options: dict, history: Optional[DrawingHistory],
+                       baseKey: Optional[str],
+                       limits: Optional[TreeLimits] = None) -> bytes:
+    """Returns the JSON that /edit responds with. It always has the "key" that the
+    client should send as the "base" of its next request and the "width" of the
+    drawing. If the drawing with the key baseKey is still in history, it also has
+    "base" (which is baseKey again) and a patch against that drawing: the new
+    "viewBox", the ids of the shapes to "remove", the shapes to "add" (with their
+    "id", the id of the "group" to add them to, their "tag", their "attrs" and
+    maybe their "text"), and the shapes to "change" (with their "id", the "attrs"
+    to change, where null means removing one, and their new "text", if it
+    changed). Otherwise, it has the whole "svg" as markup. If the drawing has
+    more shapes than limits allow, a TreeTooLargeError is raised instead, and the
+    drawing isn't remembered."""
+    key = DrawingHistory.getKey(options)
+    base = None
+    if history is not None and baseKey is not None:
+        base = history.get(baseKey)
+    drawing, patch, svg = drawTree(options, base)
+    checkSVGShapes(len(drawing.shapes), limits)
+    if history is not None:
+        history.put(key, drawing)
+    response = {"key": key, "width": drawing.width}
+    if patch is not None:
+        response |= {"base": baseKey} | patch
+    else:
+        response["svg"] = svg.render(compact=True)
+    return json.dumps(response).encode("utf-8")
+
+
+if __name__ == "__main__":
+    from artist import visualizeBinaryTree
+
+    def applyPatch(shapes: dict, drawing: Drawing, patch: dict):
+        """Applies a patch to a dict of shape ids to their groups and attributes,
+        like the frontend does to its SVG."""
+        for shapeId in patch["remove"]:
+            del shapes[shapeId]
+        for shape in patch["add"]:
+            shapes[shape["id"]] = (shape["group"], shape["attrs"],
+                                   shape.get("text"))
+        for shape in patch["change"]:
+            group, attrs, text = shapes[shape["id"]]
+            shapes[shape["id"]] = (group, attrs | shape["attrs"],
+                                   shape.get("text", text))
+
+    def getShapeDict(drawing: Drawing) -> dict:
+        return {shapeId: (
+            groupId, dict(zip(drawing.groups[groupId][1][1:], row[1:])) |
+            drawing.groups[groupId][2],
+            row[-1] if drawing.groups[groupId][3] else None)
+            for shapeId, (groupId, row) in drawing.shapes.items()}
+
+    labels = [str(i) for i in range(1, 64)]
+    edits = [
+        # relabeling, deleting a node so that it becomes a ghost, deleting a whole
+        # subtree, and adding a node under a placeholder
+        lambda e: e.__setitem__(5, "$red x"),
+        lambda e: e.__setitem__(2, ""),
+        lambda e: [e.__setitem__(i, "") for i in (9, 19, 20, 39, 40, 41, 42)],
+        lambda e: e.__setitem__(2, "up"),
+    ]
+    for squares in (False, True):
+        for compact in (False, True):
+            spec = {"elements": list(labels), "squares": squares,
+                    "squaresBlack": True, "bg": False, "compact": compact}
+            options = {**spec, "elements": [x or None for x in spec["elements"]]}
+            history = DrawingHistory()
+            response = json.loads(renderEditResponse(options, history, None))
+            assert "svg" in response, "first drawing should be sent whole"
+            drawing = history.get(response["key"])
+            shapes = getShapeDict(drawing)
+            for edit in edits:
+                edit(spec["elements"])
+                options = {**spec,
+                           "elements": [x or None for x in spec["elements"]]}
+                response = json.loads(
+                    renderEditResponse(options, history, response["key"]))
+                assert compact or "remove" in response, \
+                    "small edits should be sent as patches"
+                drawing = history.get(response["key"])
+                if "remove" in response:
+                    applyPatch(shapes, drawing, response)
+                else:
+                    shapes = getShapeDict(drawing)
+                tree = treeFromOptions(options)
+                fresh = Drawing.fromSVG(
+                    options, drawing.numLevels, drawing.nodeRadius,
+                    visualizeBinaryTree(tree, squares, True, False, compact, True),
+                    set())
+                assert getShapeDict(fresh) == shapes, \
+                    "patched drawing should match drawing from scratch"
+                assert drawing.drawnSlots == set(layoutBinaryTree(
+                    tree, squares, compact).nodeIndices), \
+                    "patched drawing should know which slots are drawn"
+    # sparse trees, and switching between them and lists, are patched too
+    history = DrawingHistory()
+    style = {"squares": True, "squaresBlack": True, "bg": False, "compact": False}
+    response = json.loads(renderEditResponse(
+        style | {"elements": ["a", None, "c"]}, history, None))
+    response = json.loads(renderEditResponse(
+        style | {"nodes": {0: "a", 2: "d"}}, history, response["key"]))
+    assert [shape["id"] for shape in response["change"]] == ["t2"], \
+        "relabeling a node in a sparse tree should only change its label"
+    response = json.loads(renderEditResponse(
+        style | {"nodes": {0: "a", 2: "a long label"}}, history, response["key"]))
+    assert "svg" in response, \
+        "a label that makes the nodes bigger should redraw the whole tree"
+    # empty trees can be drawn and patched too
+    for squares in (False, True):
+        history = DrawingHistory()
+        empty = style | {"squares": squares}
+        response = json.loads(renderEditResponse(
+            empty | {"elements": []}, history, None))
+        response = json.loads(renderEditResponse(
+            empty | {"nodes": {}}, history, response["key"]))
+        assert response["width"] > 0, "empty trees should still have a width"
+    print("tests passed")
@@ -0,0 +1,489 @@
+import math
+from typing import Optional
+from tree import BinaryTree, ListBasedBinaryTree
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NODE_RADIUS = 20
+NODE_DIAMETER = NODE_RADIUS * 2
+MIN_NODE_X_SPACING = 15
+NODE_Y_SPACING = 8
+# distance between the centers of two neighboring nodes in the same row, and
+# between two rows; nodes can be made bigger for long labels, which spreads them
+# out accordingly
+NODE_X_PITCH = NODE_DIAMETER + MIN_NODE_X_SPACING
+NODE_Y_PITCH = NODE_DIAMETER + NODE_Y_SPACING
+# these need only affect the viewbox:
+VERTICAL_MARGIN = 10
+HORIZONTAL_MARGIN = 10
+# trees whose lists are shorter than this are laid out faster without NumPy
+NUMPY_MIN_LIST_LENGTH = 2048
+# past this, node positions don't fit into NumPy's integers and floats exactly
+NUMPY_MAX_LEVELS = 52
+
+getLevelOfIndex = BinaryTree.getLevelOfIndex
+
+
+class TreeLayout:
+    """Everything that needs to be drawn to visualize a tree, already positioned.
+    Nodes and edges are stored as parallel lists, one entry per drawn shape, with
+    the nodes ordered from the bottom row up and from left to right within each
+    row. Nodes whose label is None are either placeholder external nodes or
+    dashed "ghosts" of nodes that are missing but have children. Every node has
+    the same radius, which is half the side of a square."""
+
+    def __init__(self, nodeRadius: float = NODE_RADIUS):
+        self.minX = 0
+        self.minY = 0
+        self.width = 0
+        self.height = 0
+        self.nodeRadius = nodeRadius
+        # per-node data
+        self.nodeIndices = []
+        self.nodeXs = []
+        self.nodeYs = []
+        self.nodeLabels = []
+        self.nodeIsSquare = []
+        self.nodeIsDashed = []
+        # per-edge data; each edge goes from a parent down to one of its children
+        self.edgeChildIndices = []
+        self.edgeX1s = []
+        self.edgeY1s = []
+        self.edgeX2s = []
+        self.edgeY2s = []
+        self.edgeIsDashed = []
+
+    @property
+    def viewBox(self) -> str:
+        # SVG viewbox format is "minX minY width height"
+        return f"{self.minX} {self.minY} {self.width} {self.height}"
+
+    @property
+    def nodeCount(self) -> int:
+        return len(self.nodeIndices)
+
+
+def getDrawnSlots(tree: BinaryTree, addBlankExternalNodes: bool) -> dict:
+    """Finds every node slot that will be drawn, touching only the slots of nodes
+    that exist, their ancestors, and their immediate children. Returns a dict that
+    maps the list index of each drawn slot to whether a real node exists there."""
+    drawn = {i: True for i in tree.getExistingIndices()}
+    realIndices = list(drawn)
+    # missing nodes that have descendants are drawn as ghosts; we walk upwards
+    # until we run into something that is already being drawn, so that each ghost
+    # is only visited once
+    for index in realIndices:
+        parent = (index - 1) // 2
+        while index > 0 and parent not in drawn:
+            drawn[parent] = False
+            index = parent
+            parent = (index - 1) // 2
+    if addBlankExternalNodes:
+        for index in realIndices:
+            for child in (index * 2 + 1, index * 2 + 2):
+                if child not in drawn:
+                    drawn[child] = False
+    return drawn
+
+
+def getCompactXPositions(order: list, drawn: dict,
+                         pitch: float = NODE_X_PITCH) -> dict:
+    """Packs the drawn slots horizontally in the manner of Reingold and Tilford:
+    each subtree is laid out on its own, then its two child subtrees are pushed
+    together until their facing contours are pitch apart. order must list
+    children before their parents. Returns a dict mapping each slot to its x
+    position relative to the root."""
+    halfPitch = pitch / 2
+    # x position of each slot relative to its parent
+    relX = {}
+    # contours are stored as [entries, offset] pairs, where entries lists the
+    # leftmost (or rightmost) x position at each depth of a subtree, deepest first,
+    # and offset is added to every entry; this lets a subtree be shifted and its
+    # contour reused by its parent in constant time
+    leftContours = {}
+    rightContours = {}
+    for index in order:
+        leftChild = index * 2 + 1
+        rightChild = index * 2 + 2
+        hasLeft = leftChild in drawn
+        hasRight = rightChild in drawn
+        if hasLeft and hasRight:
+            facingLeft = rightContours.pop(leftChild)
+            facingRight = leftContours.pop(rightChild)
+            leftEntries, leftOffset = facingLeft
+            rightEntries, rightOffset = facingRight
+            separation = pitch
+            for depth in range(1, min(len(leftEntries), len(rightEntries)) + 1):
+                gap = ((leftEntries[-depth] + leftOffset) -
+                       (rightEntries[-depth] + rightOffset) + pitch)
+                if gap > separation:
+                    separation = gap
+            relX[leftChild] = -separation / 2
+            relX[rightChild] = separation / 2
+            outerLeft = leftContours.pop(leftChild)
+            outerRight = rightContours.pop(rightChild)
+            outerLeft[1] -= separation / 2
+            facingLeft[1] -= separation / 2
+            outerRight[1] += separation / 2
+            facingRight[1] += separation / 2
+            newLeft = mergeContours(outerLeft, facingRight)
+            newRight = mergeContours(outerRight, facingLeft)
+        elif hasLeft or hasRight:
+            child = leftChild if hasLeft else rightChild
+            relX[child] = -halfPitch if hasLeft else halfPitch
+            newLeft = leftContours.pop(child)
+            newRight = rightContours.pop(child)
+            newLeft[1] += relX[child]
+            newRight[1] += relX[child]
+        else:
+            newLeft = [[], 0.0]
+            newRight = [[], 0.0]
+        newLeft[0].append(-newLeft[1])
+        newRight[0].append(-newRight[1])
+        leftContours[index] = newLeft
+        rightContours[index] = newRight
+    xPositions = {}
+    for index in reversed(order):
+        if index not in relX:
+            xPositions[index] = 0.0
+        else:
+            xPositions[index] = xPositions[(index - 1) // 2] + relX[index]
+    return xPositions
+
+
+def mergeContours(near: list, far: list) -> list:
+    """Combines the contour of one child subtree with the contour on the same side
+    of the other child subtree, which only shows through where near runs out.
+    Whichever entry list is longer is reused, so this costs time proportional to
+    the shorter one."""
+    nearEntries, nearOffset = near
+    farEntries, farOffset = far
+    if len(nearEntries) >= len(farEntries):
+        return near
+    start = len(farEntries) - len(nearEntries)
+    for i, entry in enumerate(nearEntries):
+        farEntries[start + i] = entry + nearOffset - farOffset
+    return far
+
+
+def makeFullLayout(numLevels: int, nodeRadius: float = NODE_RADIUS) -> tuple:
+    """Starts off a TreeLayout with the dimensions of a drawing where nodes are
+    spaced as if the tree were complete. Returns it along with the x position of
+    the leftmost possible node."""
+    result = TreeLayout(nodeRadius)
+    nodesInLastLevel = ListBasedBinaryTree.getMaxNodeCountByLevel(numLevels)
+    # the distance between the left edge of the leftmost circle and the right edge
+    # of the rightmost circle
+    finalWidth = (nodesInLastLevel * nodeRadius * 2 +
+                  (nodesInLastLevel - 1) * MIN_NODE_X_SPACING)
+    finalHeight = getLayoutHeight(numLevels, nodeRadius)
+    result.minX = (-finalWidth / 2) - HORIZONTAL_MARGIN
+    result.minY = -nodeRadius - VERTICAL_MARGIN
+    result.width = finalWidth + HORIZONTAL_MARGIN * 2
+    result.height = finalHeight + VERTICAL_MARGIN * 2
+    return result, -finalWidth / 2 + nodeRadius
+
+
+def getLayoutHeight(numLevels: int, nodeRadius: float) -> float:
+    return numLevels * nodeRadius * 2 + (numLevels - 1) * NODE_Y_SPACING
+
+
+def getPitches(nodeRadius: float) -> tuple:
+    """Returns the horizontal and vertical distances between the centers of
+    neighboring nodes with the given radius."""
+    return (nodeRadius * 2 + MIN_NODE_X_SPACING,
+            nodeRadius * 2 + NODE_Y_SPACING)
+
+
+def getFullX(index: int, numLevels: int, lowestCenterX: float,
+             pitch: float = NODE_X_PITCH) -> float:
+    """Returns the x position of a slot in an uncompacted layout, where each node is
+    centered over the slots that its descendants would take up in the lowest row,
+    if it were full."""
+    level = getLevelOfIndex(index)
+    slotsBelow = 2**(numLevels - level)
+    number = index - ListBasedBinaryTree.getLevelStart(level)
+    return lowestCenterX + pitch * (number * slotsBelow + (slotsBelow - 1) / 2)
+
+
+def getY(index: int, pitch: float = NODE_Y_PITCH) -> float:
+    return (getLevelOfIndex(index) - 1) * pitch
+
+
+def addSlotsToLayout(result: TreeLayout, tree: BinaryTree, order: list,
+                     drawn: dict, getX):
+    """Adds the nodes in the slots listed in order to result, along with the edges
+    down to their children. drawn has to map each of those slots, and each of their
+    children that is drawn, to whether a real node exists there."""
+    yPitch = getPitches(result.nodeRadius)[1]
+    for index in order:
+        x = getX(index)
+        y = getY(index, yPitch)
+        exists = drawn[index]
+        drawnChildren = [c for c in (index * 2 + 1, index * 2 + 2) if c in drawn]
+        # missing nodes that are drawn because they have children are represented
+        # as dashed-line ghosts
+        dashed = not exists and len(drawnChildren) > 0
+        result.nodeIndices.append(index)
+        result.nodeXs.append(x)
+        result.nodeYs.append(y)
+        result.nodeLabels.append(tree.getNodeByIndex(index) if exists else None)
+        # this might be different from Actually being external if we drew
+        # placeholder blank children for this node
+        result.nodeIsSquare.append(len(drawnChildren) == 0)
+        result.nodeIsDashed.append(dashed)
+        for child in drawnChildren:
+            result.edgeChildIndices.append(child)
+            result.edgeX1s.append(x)
+            result.edgeY1s.append(y)
+            result.edgeX2s.append(getX(child))
+            result.edgeY2s.append(getY(child, yPitch))
+            result.edgeIsDashed.append(dashed)
+
+
+def layoutBinaryTree(tree: BinaryTree,
+                     addBlankExternalNodes: bool = False,
+                     compact: bool = False,
+                     useNumPy: Optional[bool] = None,
+                     nodeRadius: float = NODE_RADIUS) -> TreeLayout:
+    """Works out where every node and edge in the drawing of the tree should go. The
+    root node is placed at the origin. Only the nodes that are drawn are ever
+    visited, so the time and memory this takes are proportional to the number of
+    nodes in the tree rather than to the number of slots in its lowest level.
+
+    By default, the nodes are spaced as if the tree were complete, with each node
+    centered over the slots of its descendants in the lowest row. If compact is
+    True, subtrees are instead packed as closely together as they can be, which
+    keeps deep and lopsided trees from becoming enormously wide.
+
+    Large trees that aren't being packed are laid out with NumPy, if it's installed
+    and they are stored as lists; useNumPy can be set to True or False to force the
+    choice either way. The result is the same either way.
+
+    nodeRadius is the radius of every node, which the spacing grows along with;
+    see styles.LabelTable.nodeRadius for one that fits the tree's labels."""
+    numLevels = getNumLevels(tree, addBlankExternalNodes)
+    isList = type(tree) is ListBasedBinaryTree
+    if useNumPy is None:
+        useNumPy = (numpy is not None and not compact and isList and
+                    len(tree.list) >= NUMPY_MIN_LIST_LENGTH)
+    if useNumPy and isList and not compact and 0 < numLevels <= NUMPY_MAX_LEVELS:
+        return layoutWithNumPy(tree, numLevels, addBlankExternalNodes,
+                               nodeRadius)
+
+    drawn = getDrawnSlots(tree, addBlankExternalNodes)
+    # rows are drawn from the bottom up and from left to right, which conveniently
+    # also puts each node after both of its children
+    order = sorted(drawn, key=lambda i: (-getLevelOfIndex(i), i))
+
+    xPitch = getPitches(nodeRadius)[0]
+    if compact:
+        result = TreeLayout(nodeRadius)
+        xPositions = getCompactXPositions(order, drawn, xPitch)
+        lowestX = min(xPositions.values(), default=0.0)
+        highestX = max(xPositions.values(), default=0.0)
+        finalWidth = math.ceil(highestX - lowestX) + nodeRadius * 2
+        finalHeight = getLayoutHeight(numLevels, nodeRadius)
+        result.minX = lowestX - nodeRadius - HORIZONTAL_MARGIN
+        result.minY = -nodeRadius - VERTICAL_MARGIN
+        result.width = finalWidth + HORIZONTAL_MARGIN * 2
+        result.height = finalHeight + VERTICAL_MARGIN * 2
+    else:
+        result, lowestCenterX = makeFullLayout(numLevels, nodeRadius)
+
+    if compact:
+        getX = xPositions.__getitem__
+    else:
+        def getX(index: int) -> float:
+            return getFullX(index, numLevels, lowestCenterX, xPitch)
+
+    addSlotsToLayout(result, tree, order, drawn, getX)
+    return result
+
+
+def getNumLevels(tree: BinaryTree, addBlankExternalNodes: bool) -> int:
+    return tree.height if not addBlankExternalNodes else tree.height + 1
+
+
+def getAffectedSlots(changedIndices, addBlankExternalNodes: bool) -> set:
+    """Returns the slots whose drawing can change when the nodes at changedIndices
+    are added, removed or relabeled: those slots themselves, every one of their
+    ancestors (which can turn into or stop being ghosts, or lose or gain edges),
+    and, with placeholder external nodes, their children."""
+    affected = set()
+    for index in changedIndices:
+        if addBlankExternalNodes:
+            affected.add(index * 2 + 1)
+            affected.add(index * 2 + 2)
+        while index not in affected:
+            affected.add(index)
+            if index == 0:
+                break
+            index = (index - 1) // 2
+    return affected
+
+
+def layoutSlots(tree: BinaryTree, addBlankExternalNodes: bool,
+                slots: set, drawnBefore: set,
+                nodeRadius: float = NODE_RADIUS) -> TreeLayout:
+    """Lays out part of an uncompacted drawing again after some of the tree's nodes
+    changed, for a tree that was drawn with the slots in drawnBefore and has the
+    same number of levels and node radius as it did then. slots should come from
+    getAffectedSlots; everything outside of them is drawn the same way that it
+    was before. The result has the full drawing's dimensions, but only holds the
+    nodes in slots that are still drawn and the edges down from them."""
+    numLevels = getNumLevels(tree, addBlankExternalNodes)
+    result, lowestCenterX = makeFullLayout(numLevels, nodeRadius)
+    xPitch = getPitches(nodeRadius)[0]
+    order = sorted(slots, key=lambda i: (-getLevelOfIndex(i), i))
+    drawn = {}
+    # like in getDrawnSlots, but a slot at a time and from the bottom up, so that
+    # its children have been settled by the time each slot is looked at
+    for index in order:
+        exists = tree.nodeExistsByIndex(index)
+        hasDrawnChild = any(
+            c in drawn or (c not in slots and c in drawnBefore)
+            for c in (index * 2 + 1, index * 2 + 2))
+        hasRealParent = index > 0 and tree.nodeExistsByIndex((index - 1) // 2)
+        if exists or hasDrawnChild or (addBlankExternalNodes and hasRealParent):
+            drawn[index] = exists
+    order = [i for i in order if i in drawn]
+    # edges down to children that didn't change still have to be drawn
+    for index in order:
+        for child in (index * 2 + 1, index * 2 + 2):
+            if child not in slots and child in drawnBefore:
+                drawn[child] = tree.nodeExistsByIndex(child)
+
+    def getX(index: int) -> float:
+        return getFullX(index, numLevels, lowestCenterX, xPitch)
+
+    addSlotsToLayout(result, tree, order, drawn, getX)
+    return result
+
+
+def layoutWithNumPy(tree: ListBasedBinaryTree, numLevels: int,
+                    addBlankExternalNodes: bool,
+                    nodeRadius: float = NODE_RADIUS) -> TreeLayout:
+    """Does what layoutBinaryTree does for uncompacted layouts, but a whole row at a
+    time with NumPy arrays. This goes over every slot in the tree's list instead of
+    only the drawn ones, but that's how big the list is anyway."""
+    slotCount = 2**numLevels - 1
+    exists = numpy.zeros(slotCount, dtype=bool)
+    exists[:len(tree.list)] = numpy.fromiter(
+        (x is not None for x in tree.list), dtype=bool, count=len(tree.list))
+    drawn = exists.copy()
+    hasDrawnChild = numpy.zeros(slotCount, dtype=bool)
+    # working from the bottom up means each row's children are settled before it is
+    for level in range(numLevels, 0, -1):
+        start = ListBasedBinaryTree.getLevelStart(level)
+        end = start * 2 + 1
+        if level < numLevels:
+            hasDrawnChild[start:end] = drawn[end:end * 2 + 1].reshape(
+                -1, 2).any(axis=1)
+            # missing nodes with children are drawn as ghosts
+            drawn[start:end] |= hasDrawnChild[start:end]
+        if addBlankExternalNodes and level > 1:
+            # and so are placeholder children of existing nodes
+            hasRealParent = numpy.repeat(exists[start // 2:start], 2)
+            drawn[start:end] |= hasRealParent
+    ghost = drawn & ~exists & hasDrawnChild
+
+    result, lowestCenterX = makeFullLayout(numLevels, nodeRadius)
+    xPitch, yPitch = getPitches(nodeRadius)
+    # each level's slice of these arrays is only made once, from the bottom up
+    levelIndices = []
+    levelXs = []
+    for level in range(numLevels, 0, -1):
+        start = ListBasedBinaryTree.getLevelStart(level)
+        indices = numpy.flatnonzero(drawn[start:start * 2 + 1])
+        slotsBelow = 2**(numLevels - level)
+        # this has to do the same arithmetic in the same order as getFullX does for
+        # the results to be identical
+        levelXs.append(lowestCenterX + xPitch * (
+            (indices * slotsBelow).astype(numpy.float64) + (slotsBelow - 1) / 2))
+        levelIndices.append(indices + start)
+    nodeIndices = numpy.concatenate(levelIndices)
+    nodeLevels = numpy.concatenate(
+        [numpy.full(len(indices), numLevels - i)
+         for i, indices in enumerate(levelIndices)])
+    result.nodeIndices = nodeIndices.tolist()
+    result.nodeXs = numpy.concatenate(levelXs).tolist()
+    result.nodeYs = ((nodeLevels - 1) * yPitch).tolist()
+    nodeExists = exists[nodeIndices]
+    result.nodeLabels = [tree.list[i] if real else None
+                         for i, real in zip(result.nodeIndices, nodeExists.tolist())]
+    result.nodeIsSquare = (~hasDrawnChild[nodeIndices]).tolist()
+    result.nodeIsDashed = ghost[nodeIndices].tolist()
+
+    # every drawn child gets an edge from its parent; they are ordered by parent,
+    # with left children before right ones
+    xByIndex = numpy.zeros(slotCount)
+    xByIndex[nodeIndices] = numpy.concatenate(levelXs)
+    edgeChildIndices = []
+    edgeParentLevels = []
+    for level in range(numLevels - 1, 0, -1):
+        childStart = ListBasedBinaryTree.getLevelStart(level + 1)
+        children = numpy.flatnonzero(
+            drawn[childStart:childStart * 2 + 1]) + childStart
+        edgeChildIndices.append(children)
+        edgeParentLevels.append(numpy.full(len(children), level - 1))
+    children = numpy.concatenate(edgeChildIndices or [numpy.zeros(0, dtype=int)])
+    parentLevels = numpy.concatenate(edgeParentLevels or [numpy.zeros(0, dtype=int)])
+    parents = (children - 1) // 2
+    result.edgeChildIndices = children.tolist()
+    result.edgeX1s = xByIndex[parents].tolist()
+    result.edgeY1s = (parentLevels * yPitch).tolist()
+    result.edgeX2s = xByIndex[children].tolist()
+    result.edgeY2s = ((parentLevels + 1) * yPitch).tolist()
+    result.edgeIsDashed = ghost[parents].tolist()
+    return result
+
+
+if __name__ == "__main__":
+    # a full tree's nodes should be evenly spaced in the bottom row and centered
+    # over their children
+    full = layoutBinaryTree(ListBasedBinaryTree(["a", "b", "c"]))
+    assert full.nodeXs == [-27.5, 27.5, 0], "full layout is not symmetrical"
+    assert full.viewBox == "-57.5 -30 115 108", "full layout has the wrong viewBox"
+    # a long chain should not need space for every slot in its bottom row
+    chainList = [None] * (2**16 - 1)
+    index = 0
+    while index < len(chainList):
+        chainList[index] = "x"
+        index = index * 2 + 2
+    chainLayout = layoutBinaryTree(ListBasedBinaryTree(chainList), True, True)
+    assert chainLayout.nodeCount == 16 * 2 + 1, "chain has the wrong node count"
+    assert chainLayout.width < 2000, "compact chain layout is too wide"
+    from tree import SparseBinaryTree
+    sparseChain = SparseBinaryTree(
+        {i: x for i, x in enumerate(chainList) if x is not None})
+    for compact in (False, True):
+        assert vars(layoutBinaryTree(sparseChain, True, compact)) == vars(
+            layoutBinaryTree(ListBasedBinaryTree(chainList), True, compact)), \
+            "sparse trees should be laid out just like lists"
+    # children should never overlap in the compact layout
+    bushy = layoutBinaryTree(
+        ListBasedBinaryTree([str(i) for i in range(1, 64)]), True, True)
+    for level in set(map(getLevelOfIndex, bushy.nodeIndices)):
+        row = sorted(x for i, x in zip(bushy.nodeIndices, bushy.nodeXs)
+                     if getLevelOfIndex(i) == level)
+        assert all(b - a >= NODE_X_PITCH for a, b in zip(row, row[1:])), \
+            "compact layout put two nodes too close together"
+    # bigger nodes should be spread out to match
+    wide = layoutBinaryTree(ListBasedBinaryTree(["a", "b", "c"]), nodeRadius=30)
+    assert wide.nodeXs == [-37.5, 37.5, 0] and wide.nodeYs[0] == 68, \
+        "bigger nodes should be spaced further apart"
+    # the NumPy path should lay out every tree exactly like the plain one
+    if numpy is not None:
+        sparse = ListBasedBinaryTree([None if i % 7 == 3 else i for i in range(300)])
+        for addBlank, radius in ((False, NODE_RADIUS), (True, NODE_RADIUS),
+                                 (True, 33)):
+            plain = layoutBinaryTree(sparse, addBlank, useNumPy=False,
+                                     nodeRadius=radius)
+            vectorized = layoutBinaryTree(sparse, addBlank, useNumPy=True,
+                                          nodeRadius=radius)
+            assert vars(plain) == vars(vectorized), \
+                "NumPy layout does not match the plain layout"
+    print("tests passed")
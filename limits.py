@@ -0,0 +1,239 @@
+"""Bounds on how much work the server will take on for one tree, and a scanner that
+checks a tree spec against them while its JSON is still arriving, so that a body
+that is too big or malformed in a costly way can be turned away before all of it
+has been read, let alone parsed."""
+import codecs
+import json
+import re
+from typing import Optional
+from layout import getNumLevels, makeFullLayout
+from styles import LabelTable
+from tree import TreeTooLargeError, treeFromOptions
+
+# cairo can't make images any wider or taller than this
+CAIRO_MAX_SIZE = 32767
+
+
+class TreeLimits:
+    """How big a tree the server will draw. maxBodyBytes bounds the JSON of one
+    tree spec and maxBatchBytes the JSON of a whole batch; maxNodes bounds the
+    nodes that exist, maxHeight the number of levels in the list representation
+    (which also bounds its length), maxStringBytes the JSON of any one label,
+    maxPNGPixels the area of a PNG, and maxSVGShapes the nodes, labels, edges and
+    squares in an SVG (see SVGElement.countShapes). The default maxSVGShapes is a
+    little more than the most shapes that a tree with maxNodes nodes can have."""
+
+    def __init__(self,
+                 maxBodyBytes: int = 2**20,
+                 maxBatchBytes: int = 8 * 2**20,
+                 maxNodes: int = 10000,
+                 maxHeight: int = 20,
+                 maxStringBytes: int = 256,
+                 maxPNGPixels: int = 16 * 2**20,
+                 maxSVGShapes: int = 60000):
+        self.maxBodyBytes = maxBodyBytes
+        self.maxBatchBytes = maxBatchBytes
+        self.maxNodes = maxNodes
+        self.maxHeight = maxHeight
+        self.maxStringBytes = maxStringBytes
+        self.maxPNGPixels = maxPNGPixels
+        self.maxSVGShapes = maxSVGShapes
+
+
+def checkPNGSize(width: float, height: float, scale: float,
+                 limits: Optional[TreeLimits]):
+    """Raises a TreeTooLargeError if a drawing of the given size can't be made into
+    a PNG at the given scale."""
+    width *= scale
+    height *= scale
+    if width > CAIRO_MAX_SIZE or height > CAIRO_MAX_SIZE or (
+            limits is not None and width * height > limits.maxPNGPixels):
+        raise TreeTooLargeError(
+            f"a {width:.0f}x{height:.0f} PNG would be too large")
+
+
+def checkSVGShapes(shapeCount: int, limits: Optional[TreeLimits]):
+    """Raises a TreeTooLargeError if a drawing with shapeCount shapes is bigger
+    than limits allow, so that it isn't sent."""
+    if limits is not None and shapeCount > limits.maxSVGShapes:
+        raise TreeTooLargeError(
+            f"an SVG with {shapeCount} shapes would be too large")
+
+
+def checkTreeLimits(options: dict, limits: TreeLimits,
+                    pngScale: Optional[float] = None):
+    """Raises a TreeTooLargeError if a tree with the given normalized options (see
+    rendering.normalizeTreeSpec) is bigger than limits allow. If pngScale is given,
+    the size of a PNG at that scale is checked too, as long as it can be known
+    without laying the tree out (the rest is up to rendering.renderPNG)."""
+    tree = treeFromOptions(options)
+    if tree.height > limits.maxHeight:
+        raise TreeTooLargeError(f"tree is more than {limits.maxHeight} levels tall")
+    if tree.countNodes() > limits.maxNodes:
+        raise TreeTooLargeError(f"tree has more than {limits.maxNodes} nodes")
+    if pngScale is not None and not options.get("compact", False):
+        labels = LabelTable.fromLabels(tree.getLabels(), options.get("palette"))
+        full, _ = makeFullLayout(getNumLevels(tree, options.get("squares", False)),
+                                 labels.nodeRadius)
+        checkPNGSize(full.width, full.height, pngScale, limits)
+
+
+class TreeSpecScanner:
+    """Follows the JSON of a tree spec as it is fed in a chunk at a time, raising a
+    TreeTooLargeError as soon as it has seen more bytes, nodes or levels (judging by
+    the length of the "elements" list, or the nesting of a "tree") than limits
+    allow, or a string that is too long, and a ValueError if it is nested more
+    deeply than a tree spec ever is. Nodes are counted in "elements" and "labels"
+    lists and as "label"s in a "tree"; the "brackets" string can be as long as the
+    body, and its nodes are left to checkTreeLimits. Everything else about the JSON
+    is left for the real parser to check once all of it has arrived."""
+    # strings, which might be cut off by the end of a chunk, and punctuation;
+    # anything else, like numbers, doesn't matter here
+    token = re.compile(r'"((?:[^"\\]|\\.)*)(")?|[\[\]{}:,]', re.DOTALL)
+
+    def __init__(self, limits: TreeLimits, maxDepth: int = 2):
+        self.limits = limits
+        self.maxDepth = maxDepth
+        self.size = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        # the end of the last chunk, if it was in the middle of a string
+        self.leftover = ""
+        self.depth = 0
+        self.lastString = None
+        # the key in the top-level object whose value is being read
+        self.currentKey = None
+        self.inElements = False
+        self.elementCount = 0
+        self.nodeCount = 0
+        self.maxElements = 2**limits.maxHeight - 1
+
+    def feed(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.limits.maxBodyBytes:
+            raise TreeTooLargeError(
+                f"request is longer than {self.limits.maxBodyBytes} bytes")
+        text = self.leftover + self.decoder.decode(chunk)
+        self.leftover = ""
+        for match in self.token.finditer(text):
+            token = match.group()
+            if token[0] == '"':
+                if match.group(2) is None:
+                    # the string goes on in the next chunk
+                    self.leftover = text[match.start():]
+                    if len(self.leftover) > self.maxStringLength:
+                        raise TreeTooLargeError("string is too long")
+                    return
+                self.readString(match.group(1))
+            elif token in "[{":
+                self.depth += 1
+                if self.currentKey == "tree" and self.depth > self.maxDepth:
+                    # each level of a nested tree is another object deep
+                    if self.depth > self.limits.maxHeight + 1:
+                        raise TreeTooLargeError(
+                            f"tree is more than {self.limits.maxHeight} levels tall")
+                elif self.depth > self.maxDepth + (self.currentKey == "palette"):
+                    # a palette's colors can be in lists, one level deeper than
+                    # anything else but a tree
+                    raise ValueError("JSON is nested too deeply")
+                self.inElements = (token == "[" and self.depth == 2 and
+                                   self.currentKey in ("elements", "labels"))
+            elif token in "]}":
+                self.depth -= 1
+                self.inElements = False
+            elif token == ":":
+                if self.depth == 1:
+                    self.currentKey = self.lastString
+                elif self.currentKey == "tree" and self.lastString == "label":
+                    self.countNode()
+
+    @property
+    def maxStringLength(self) -> int:
+        if self.depth == 1 and self.currentKey == "brackets":
+            return self.limits.maxBodyBytes
+        return self.limits.maxStringBytes
+
+    def readString(self, content: str):
+        if len(content) + 2 > self.maxStringLength:
+            raise TreeTooLargeError("string is too long")
+        self.lastString = content
+        if not self.inElements:
+            return
+        if self.currentKey == "elements":
+            self.elementCount += 1
+            if self.elementCount > self.maxElements:
+                raise TreeTooLargeError(
+                    f"tree is more than {self.limits.maxHeight} levels tall")
+        if "\\" in content:
+            try:
+                content = json.loads('"' + content + '"')
+            except ValueError:
+                pass
+        if content.strip() != "":
+            self.countNode()
+
+    def countNode(self):
+        self.nodeCount += 1
+        if self.nodeCount > self.limits.maxNodes:
+            raise TreeTooLargeError(
+                f"tree has more than {self.limits.maxNodes} nodes")
+
+
+if __name__ == "__main__":
+    from artist import visualizeTreeSpec
+
+    limits = TreeLimits(maxBodyBytes=1000, maxNodes=5, maxHeight=3,
+                        maxStringBytes=20)
+    spec = json.dumps({"elements": ["a", " ", "\\u0062", "", "c"], "squares": True,
+                       "bg": False}).encode("utf-8")
+    scanner = TreeSpecScanner(limits)
+    for i in range(len(spec)):
+        scanner.feed(spec[i:i + 1])
+    assert scanner.elementCount == 5 and scanner.nodeCount == 3, \
+        "scanner should count elements and nodes fed a byte at a time"
+
+    def rejects(body: bytes, error=TreeTooLargeError) -> bool:
+        try:
+            TreeSpecScanner(limits).feed(body)
+        except error:
+            return True
+        return False
+
+    assert rejects(b'{"elements": ["1", "2", "3", "4", "5", "6", "7", "8"]}'), \
+        "scanner should reject trees that are too tall"
+    assert rejects(b'{"elements": ["1", "2", "3", "4", "5", "6", ""]}'), \
+        "scanner should reject trees with too many nodes"
+    assert rejects(b'{"elements": ["' + b"x" * 30), \
+        "scanner should reject long strings before they end"
+    assert rejects(b'{"elements": [[[]]]}', ValueError), \
+        "scanner should reject deeply nested JSON"
+    assert not rejects(b'{"squares": ["1", "2", "3", "4", "5", "6", "7", "8"]}'), \
+        "only the elements list counts"
+    nested = {"label": "a", "left": {"label": "b", "left": {"label": "c"}}}
+    assert not rejects(json.dumps({"tree": nested}).encode("utf-8")), \
+        "trees as tall as the limit should get through"
+    nested = {"label": "a", "left": nested}
+    assert rejects(json.dumps({"tree": nested}).encode("utf-8")), \
+        "nested trees that are too tall should be rejected"
+    assert rejects(json.dumps({"labels": list("abcdef")}).encode("utf-8")), \
+        "labels should count as nodes"
+    assert not rejects(json.dumps({"brackets": "a" * 100}).encode("utf-8")), \
+        "bracket notation can be longer than other strings"
+    assert not rejects(b'{"palette": {"x": ["red", "white"]}}'), \
+        "palettes can have lists of colors"
+    checkTreeLimits({"elements": ["a"] * 5, "squares": False}, limits)
+    # five nodes make five circles, five labels and four edges
+    checkSVGShapes(visualizeTreeSpec({"elements": ["a"] * 5}).countShapes(),
+                   TreeLimits(maxSVGShapes=14))
+    for check in (lambda: checkTreeLimits({"elements": ["a"] * 6}, limits),
+                  lambda: checkTreeLimits({"elements": ["a"] * 5, "squares": True},
+                                          TreeLimits(maxPNGPixels=10000), 2),
+                  lambda: checkPNGSize(1, 2**15, 1, None),
+                  lambda: checkSVGShapes(
+                      visualizeTreeSpec({"elements": ["a"] * 5}).countShapes(),
+                      TreeLimits(maxSVGShapes=10))):
+        try:
+            check()
+            assert False, "trees and images that are too big should be rejected"
+        except TreeTooLargeError:
+            pass
+    print("tests passed")
@@ -0,0 +1,260 @@
+"""Bare-bones metrics that the server exposes at /metrics, in the text format that
+Prometheus scrapes, and a timer for the stages of handling a request. Every server
+process keeps its own metrics, so with several workers, each scrape only sees the
+process that answered it; the pid label tells them apart."""
+import bisect
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+# upper bounds of the buckets for durations, in seconds, and sizes, in bytes
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                 16777216)
+
+
+def formatLabels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(
+        name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for name, value in zip(names, values)) + "}"
+
+
+def formatNumber(value: float) -> str:
+    return repr(float(value)) if type(value) is float else str(value)
+
+
+class Counter:
+    """A count that only goes up, kept separately for each combination of values of
+    labelNames."""
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labelNames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelNames = labelNames
+        self.values = {}
+
+    def inc(self, *labelValues, amount: float = 1):
+        self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def iterSamples(self) -> Iterator[str]:
+        for labelValues, value in self.values.items():
+            yield (self.name + formatLabels(self.labelNames, labelValues) + " " +
+                   formatNumber(value))
+
+
+class Histogram:
+    """Counts observations in buckets by their upper bounds, along with their sum,
+    kept separately for each combination of values of labelNames."""
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: tuple,
+                 labelNames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.labelNames = labelNames
+        # each series is [count in each bucket, plus one past the last, sum]; the
+        # counts are made cumulative when they are written out
+        self.series = {}
+
+    def observe(self, value: float, *labelValues):
+        series = self.series.get(labelValues)
+        if series is None:
+            series = self.series[labelValues] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def iterSamples(self) -> Iterator[str]:
+        names = self.labelNames + ("le",)
+        for labelValues, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield (self.name + "_bucket" +
+                       formatLabels(names, labelValues + (bound,)) + " " +
+                       str(cumulative))
+            labels = formatLabels(self.labelNames, labelValues)
+            yield self.name + "_sum" + labels + " " + formatNumber(total)
+            yield self.name + "_count" + labels + " " + str(cumulative)
+
+
+class Gauge:
+    """A value that is read from function whenever the metrics are written out.
+    function can also return a dict that maps tuples of label values to values.
+    kind can be set to "counter" for counts that are kept track of elsewhere."""
+
+    def __init__(self, name: str, description: str, function: Callable,
+                 labelNames: tuple = (), kind: str = "gauge"):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.labelNames = labelNames
+        self.kind = kind
+
+    def iterSamples(self) -> Iterator[str]:
+        value = self.function()
+        if value is None:
+            return
+        values = value if type(value) is dict else {(): value}
+        for labelValues, value in values.items():
+            yield (self.name + formatLabels(self.labelNames, labelValues) + " " +
+                   formatNumber(value))
+
+
+class MetricsRegistry:
+    """Holds metrics and writes them out in the Prometheus text format, with a pid
+    label on every sample."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        pid = 'pid="' + str(os.getpid()) + '"'
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample in metric.iterSamples():
+                if "{" in sample:
+                    lines.append(sample.replace("{", "{" + pid + ",", 1))
+                else:
+                    name, value = sample.split(" ")
+                    lines.append(name + "{" + pid + "} " + value)
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics(MetricsRegistry):
+    """Everything that /metrics reports. The request metrics are labeled with the
+    name of the handler that served them; the rest is read from the render cache
+    and pool, if there are any, and from getActiveRequests. startupSeconds can be
+    filled in with how long each stage of getting the process ready took, and the
+    duration of the first request to each handler is kept, since that is where
+    anything that wasn't loaded ahead of time shows up."""
+
+    def __init__(self, renderCache=None, renderPool=None,
+                 getActiveRequests: Optional[Callable] = None):
+        super().__init__()
+        self.requests = self.add(Counter(
+            "tree_drawer_requests_total", "Requests handled, by response status.",
+            ("handler", "status")))
+        self.requestSeconds = self.add(Histogram(
+            "tree_drawer_request_seconds", "Time from receiving a request to "
+            "finishing the response.", SECONDS_BUCKETS, ("handler",)))
+        self.stageSeconds = self.add(Histogram(
+            "tree_drawer_stage_seconds", "Time that requests spent in each stage "
+            "of being handled.", SECONDS_BUCKETS, ("handler", "stage")))
+        self.requestBytes = self.add(Histogram(
+            "tree_drawer_request_bytes", "Size of request bodies.", BYTES_BUCKETS,
+            ("handler",)))
+        self.responseBytes = self.add(Histogram(
+            "tree_drawer_response_bytes", "Size of response bodies, before "
+            "compression.", BYTES_BUCKETS, ("handler",)))
+        self.startupSeconds = {}
+        self.firstRequestSeconds = {}
+        self.add(Gauge("tree_drawer_startup_seconds", "Time that each stage of "
+                       "getting the process ready to take requests took.",
+                       lambda: {(stage,): seconds for stage, seconds
+                                in self.startupSeconds.items()}, ("stage",)))
+        self.add(Gauge("tree_drawer_first_request_seconds", "Time that the first "
+                       "request that each handler handled took.",
+                       lambda: {(handler,): seconds for handler, seconds
+                                in self.firstRequestSeconds.items()},
+                       ("handler",)))
+        if getActiveRequests is not None:
+            self.add(Gauge("tree_drawer_active_requests",
+                           "Requests that are being handled.", getActiveRequests))
+        if renderPool is not None:
+            self.add(Gauge("tree_drawer_render_jobs", "Render jobs running or "
+                           "waiting for a process.", lambda: renderPool.pending))
+            self.add(Gauge("tree_drawer_render_queue_depth", "Render jobs waiting "
+                           "for a process.", lambda: renderPool.queued))
+        if renderCache is not None:
+            for stat, description, kind in (
+                    ("entries", "Responses in the render cache.", "gauge"),
+                    ("bytes", "Size of the responses in the render cache.",
+                     "gauge"),
+                    ("hits", "Render cache lookups that found something.",
+                     "counter"),
+                    ("misses", "Render cache lookups that came up empty.",
+                     "counter"),
+                    ("evictions", "Responses evicted from the render cache.",
+                     "counter")):
+                name = "tree_drawer_cache_" + stat + (
+                    "_total" if kind == "counter" else "")
+                self.add(Gauge(name, description,
+                               lambda stat=stat: renderCache.stats[stat],
+                               kind=kind))
+
+    def observeRequest(self, handler: str, status: int, seconds: float,
+                       requestBytes: int, responseBytes: int, stages: dict):
+        self.requests.inc(handler, status)
+        self.firstRequestSeconds.setdefault(handler, seconds)
+        self.requestSeconds.observe(seconds, handler)
+        self.requestBytes.observe(requestBytes, handler)
+        self.responseBytes.observe(responseBytes, handler)
+        for stage, stageSeconds in stages.items():
+            self.stageSeconds.observe(stageSeconds, handler, stage)
+
+
+class StageTimer:
+    """Adds up how long each stage of handling a request takes, like so:
+
+        with timer.stage("layout"):
+            ...
+
+    The totals are in seconds, a plain dict that can be sent back from a worker
+    process."""
+    __slots__ = ("seconds",)
+
+    def __init__(self, seconds: Optional[dict] = None):
+        self.seconds = seconds if seconds is not None else {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+
+    def merge(self, seconds: dict):
+        for name, value in seconds.items():
+            self.add(name, value)
+
+
+if __name__ == "__main__":
+    registry = MetricsRegistry()
+    requests = registry.add(Counter("requests_total", "Requests.", ("handler",)))
+    latency = registry.add(
+        Histogram("latency_seconds", "Latency.", (0.1, 1), ("handler",)))
+    registry.add(Gauge("queue", "Queue depth.", lambda: 3))
+    requests.inc("svg")
+    requests.inc("svg", amount=2)
+    latency.observe(0.05, "svg")
+    latency.observe(0.5, "svg")
+    latency.observe(5, "svg")
+    rendered = registry.render()
+    pid = os.getpid()
+    assert f'requests_total{{pid="{pid}",handler="svg"}} 3' in rendered
+    assert f'latency_seconds_bucket{{pid="{pid}",handler="svg",le="1"}} 2' in rendered, \
+        "histogram buckets should be cumulative"
+    assert f'latency_seconds_count{{pid="{pid}",handler="svg"}} 3' in rendered
+    assert f'queue{{pid="{pid}"}} 3' in rendered
+    timer = StageTimer()
+    with timer.stage("a"):
+        pass
+    timer.merge({"a": 1, "b": 2})
+    assert timer.seconds["a"] >= 1 and timer.seconds["b"] == 2
+    print("tests passed")
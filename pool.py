@@ -0,0 +1,88 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional, Union
+
+
+class RenderPoolFullError(Exception):
+    pass
+
+
+class RenderPool:
+    """Runs rendering jobs in a pool of worker processes so that they don't hold up
+    the IOLoop, and so that they can use more than one core. At most processes jobs
+    run at once, and at most maxQueued more can wait for a turn; past that, jobs are
+    turned away with a RenderPoolFullError so that a flood of expensive requests
+    can't pile up indefinitely.
+
+    Every worker process calls initializer(), if there is one, before it takes any
+    jobs; see start."""
+
+    def __init__(self, processes: Union[int, None] = None, maxQueued: int = 32,
+                 initializer: Optional[Callable] = None):
+        self.processes = processes or os.cpu_count() or 1
+        self.maxQueued = maxQueued
+        # the workers report what initializer returned here
+        self.readyQueue = multiprocessing.SimpleQueue()
+        self.executor = ProcessPoolExecutor(
+            self.processes, initializer=initializeWorker,
+            initargs=(initializer, self.readyQueue))
+        # jobs that are running or waiting to run
+        self.pending = 0
+        # set whenever a job finishes, for the benefit of callers waiting for room
+        self.jobFinished = asyncio.Event()
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.pending - self.processes)
+
+    @property
+    def isFull(self) -> bool:
+        return self.pending >= self.processes + self.maxQueued
+
+    async def run(self, function, *args, wait: bool = False):
+        """Runs function(*args) in a worker process and returns the result. function
+        has to be importable by the workers, so it should be defined at the top level
+        of a module. If the queue is full, this waits for room if wait is True and
+        raises a RenderPoolFullError otherwise."""
+        while self.isFull:
+            if not wait:
+                raise RenderPoolFullError()
+            self.jobFinished.clear()
+            await self.jobFinished.wait()
+        self.pending += 1
+        try:
+            return await asyncio.wrap_future(
+                self.executor.submit(function, *args))
+        finally:
+            self.pending -= 1
+            self.jobFinished.set()
+
+    async def start(self) -> list:
+        """Starts every worker process and waits for them all to finish running the
+        initializer. Returns a (pid, result, error) tuple for each of them, where
+        error describes the exception that the initializer raised, if it did."""
+        # the executor only starts processes once there are jobs for them
+        for _ in range(self.processes):
+            self.executor.submit(os.getpid)
+        loop = asyncio.get_running_loop()
+        return [await loop.run_in_executor(None, self.readyQueue.get)
+                for _ in range(self.processes)]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def initializeWorker(initializer: Optional[Callable],
+                     readyQueue: multiprocessing.SimpleQueue):
+    result = None
+    error = None
+    if initializer is not None:
+        try:
+            result = initializer()
+        except Exception as e:
+            # a worker that can't be initialized can still try to do its jobs,
+            # which will report the problem properly
+            error = repr(e)
+    readyQueue.put((os.getpid(), result, error))
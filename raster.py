@@ -0,0 +1,160 @@
+"""Draws laid out trees straight onto a cairo surface and encodes them as PNGs, so
+that PNGs don't have to be made by writing out an SVG and having CairoSVG parse it
+back in. The drawing imitates what CairoSVG does with the SVGs that
+artist.drawTreeLayout makes, down to how it positions text, so that the two come
+out the same but for antialiasing noise."""
+import io
+import math
+from typing import Optional
+import cairocffi as cairo
+from artist import NODE_OUTLINE_WIDTH, DASH_LENGTH
+from layout import TreeLayout
+from styles import LabelTable, colorToRGB, NODE_TEXT_SIZE, NODE_FONT_FAMILY
+
+# CairoSVG only uses the first font family that is listed
+FONT_FACE = NODE_FONT_FAMILY.split(",")[0].strip()
+# SVG's default, which CairoSVG passes on to cairo
+MITER_LIMIT = 4
+
+
+def getSource(color: str) -> tuple:
+    """Returns a color's red, green and blue from 0 to 1, for set_source_rgb."""
+    return tuple(channel / 255 for channel in colorToRGB(color))
+
+
+def layoutToPNG(layout: TreeLayout, makeBlankExternalNodesBlack: bool = True,
+                addWhiteBG: bool = False, scale: float = 1,
+                labels: Optional[LabelTable] = None) -> bytes:
+    """Draws the laid out tree like artist.drawTreeLayout would, at scale times the
+    size of its viewBox, and returns it as a PNG."""
+    surface, context = makeSurface(layout, scale)
+    white = getSource("white")
+    black = getSource("black")
+    if addWhiteBG:
+        context.rectangle(layout.minX, layout.minY, layout.width, layout.height)
+        context.set_source_rgb(*white)
+        context.fill()
+
+    context.set_line_width(NODE_OUTLINE_WIDTH)
+    context.set_miter_limit(MITER_LIMIT)
+    # edges are grouped by whether they are dashed, so that the dash pattern and
+    # the source only have to be set twice
+    context.set_source_rgb(*black)
+    for dashed in (False, True):
+        context.set_dash([DASH_LENGTH] if dashed else [])
+        for i in range(len(layout.edgeX1s)):
+            if layout.edgeIsDashed[i] == dashed:
+                context.move_to(layout.edgeX1s[i], layout.edgeY1s[i])
+                context.line_to(layout.edgeX2s[i], layout.edgeY2s[i])
+                # each line is stroked on its own, like CairoSVG does, so that
+                # dashes start over at the top of every edge
+                context.stroke()
+
+    if labels is None:
+        labels = LabelTable.fromLabels(layout.nodeLabels)
+    # the colors of each style are worked out once, and so is each node's entry
+    entries = [labels.entries[label] for label in layout.nodeLabels]
+    shapeSources = [getSource(shapeFill or "white")
+                    for shapeFill, _ in labels.styles]
+    textSources = [getSource(textFill or "black") for _, textFill in labels.styles]
+    blankSquareSource = black if makeBlankExternalNodesBlack else white
+    radius = layout.nodeRadius
+    # all circles are drawn before all squares, in the same order as the SVG
+    for square in (False, True):
+        for i in range(layout.nodeCount):
+            if layout.nodeIsSquare[i] != square:
+                continue
+            x = layout.nodeXs[i]
+            y = layout.nodeYs[i]
+            styleId, text = entries[i]
+            if square:
+                context.rectangle(x - radius, y - radius, radius * 2, radius * 2)
+                source = (shapeSources[styleId] if text is not None else
+                          blankSquareSource)
+            else:
+                context.new_sub_path()
+                context.arc(x, y, radius, 0, 2 * math.pi)
+                source = shapeSources[styleId]
+            context.set_source_rgb(*source)
+            context.fill_preserve()
+            context.set_source_rgb(*black)
+            context.set_dash([DASH_LENGTH] if layout.nodeIsDashed[i] else [])
+            context.stroke()
+
+    context.select_font_face(FONT_FACE, cairo.FONT_SLANT_NORMAL,
+                             cairo.FONT_WEIGHT_NORMAL)
+    context.set_font_size(NODE_TEXT_SIZE)
+    ascent, descent = context.font_extents()[:2]
+    # dominant-baseline="middle", as CairoSVG understands it
+    yAlign = (ascent + descent) / 2 - descent
+    # text-anchor="middle" moves each text back by this much; it's only measured
+    # once for each distinct text
+    xAligns = {}
+    for i in range(layout.nodeCount):
+        styleId, text = entries[i]
+        if not text:
+            continue
+        xAlign = xAligns.get(text)
+        if xAlign is None:
+            xBearing, _, width = context.text_extents(text)[:3]
+            xAlign = xAligns[text] = width / 2 + xBearing
+        context.move_to(layout.nodeXs[i] - xAlign, layout.nodeYs[i] + yAlign)
+        context.text_path(text)
+        context.set_source_rgb(*textSources[styleId])
+        context.fill()
+
+    output = io.BytesIO()
+    surface.write_to_png(output)
+    return output.getvalue()
+
+
+def makeSurface(layout: TreeLayout, scale: float) -> tuple:
+    """Makes an image surface for the layout's viewBox at the given scale, sized
+    and positioned the way CairoSVG does it for an output width of scale times the
+    viewBox's width, and returns it with a context that draws in viewBox
+    coordinates."""
+    width = round(layout.width * scale)
+    height = round(layout.height * scale)
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    context = cairo.Context(surface)
+    # the viewBox is fit into the surface, which rounding might have made a bit
+    # out of proportion, and centered in it
+    fit = min(width / layout.width, height / layout.height)
+    context.translate((width - layout.width * fit) / 2,
+                      (height - layout.height * fit) / 2)
+    context.scale(fit, fit)
+    context.translate(-layout.minX, -layout.minY)
+    return surface, context
+
+
+if __name__ == "__main__":
+    from cairosvg import svg2png
+    from artist import drawTreeLayout
+    from layout import layoutBinaryTree
+    from tree import ListBasedBinaryTree
+    from styles import normalizePalette
+
+    def getPixels(png: bytes) -> tuple:
+        image = cairo.ImageSurface.create_from_png(io.BytesIO(png))
+        return image.get_width(), image.get_height(), bytes(image.get_data())
+
+    elements = [str(i) for i in range(1, 16)]
+    elements[1] = "$red 2"
+    elements[2] = None
+    elements[6] = "$black long label"
+    elements[8] = "$mine 9"
+    elements[9] = "$green 10"
+    tree = ListBasedBinaryTree(elements)
+    labels = LabelTable.fromLabels(tree.getLabels(),
+                                   normalizePalette({"mine": ["#fc0", "#008"]}))
+    for squares, bg, scale in ((False, False, 1), (True, True, 2)):
+        layout = layoutBinaryTree(tree, squares, nodeRadius=labels.nodeRadius)
+        direct = getPixels(layoutToPNG(layout, True, bg, scale, labels))
+        svg = drawTreeLayout(layout, True, bg, False, labels)
+        viaSVG = getPixels(svg2png(bytestring=svg.render(compact=True).encode(),
+                                   output_width=svg.viewBoxWidth * scale))
+        assert direct[:2] == viaSVG[:2], "PNGs should be the same size"
+        difference = sum(abs(a - b) for a, b in zip(direct[2], viaSVG[2]))
+        assert difference / len(direct[2]) < 1, \
+            "PNGs should look the same as ones made from SVGs"
+    print("tests passed")
@@ -0,0 +1,214 @@
+import json
+from urllib import parse
+from typing import Iterator, Optional
+from artist import drawTreeLayout
+from layout import layoutBinaryTree
+from limits import TreeLimits, checkPNGSize, checkSVGShapes
+from metrics import StageTimer
+from styles import LabelTable, normalizePalette
+from svg import SVGElement
+from tree import cleanLabel, parseCompactTree, treeFromOptions
+from cache import RenderCache
+
+PNG_SCALE = 2
+# this is part of every cache key and ETag, so it should be changed whenever the
+# drawings themselves change, to keep stale ones from being served
+RENDER_VERSION = 4
+
+# a tree that is drawn to get everything loaded before a process takes requests;
+# it has every kind of node and label color, so that every font is looked up
+WARM_UP_OPTIONS = {
+    "elements": ["$black 1", "$red 2", None, "4", "5", None, None, None, "warm up"],
+    "squares": True,
+    "squaresBlack": True,
+    "bg": True,
+    "compact": False
+}
+
+# these functions take the normalized options that server.ElementsHandler pulls out
+# of a request and turn them into response bodies. they are kept at the top level
+# of their own module so that they can be sent to worker processes. the ones that
+# take a StageTimer add how long they spend on each stage to it. the rasterizers,
+# with everything that they bring in, are only imported once a PNG is needed, so
+# that processes that only draw SVGs never pay for them
+
+
+def normalizeTreeSpec(treeData, maxLabelLength: Optional[int] = 10,
+                      maxHeight: Optional[int] = None) -> dict:
+    """Checks a tree spec like the ones that the frontend sends and returns it with
+    every option filled in and the labels cleaned up (and cut down to
+    maxLabelLength characters, unless that is None), so that equivalent specs come
+    out identical. Raises a ValueError if the spec is malformed.
+
+    The tree can be given as the "elements" of its list representation, which are
+    kept as they are, or in one of the compact formats that tree.parseCompactTree
+    reads, which come out as the "nodes" of a SparseBinaryTree instead. Compact
+    trees that are taller than maxHeight raise a TreeTooLargeError while they are
+    being parsed, so that deep ones can't take long.
+
+    A "palette" of extra color markers is checked with styles.normalizePalette
+    and only kept if it's there, so that specs without one come out the same as
+    they always have."""
+    if type(treeData) is not dict:
+        raise ValueError("malformed tree spec")
+    tree = parseCompactTree(treeData, maxHeight)
+    if tree is None:
+        elements = treeData.get("elements")
+        if type(elements) is not list or any(type(x) is not str for x in elements):
+            raise ValueError("malformed tree spec")
+    if (type(treeData.get("squares")) is not bool or
+            type(treeData.get("bg")) is not bool or
+            type(treeData.get("squaresBlack", True)) is not bool or
+            type(treeData.get("compact", False)) is not bool):
+        raise ValueError("malformed tree spec")
+    if tree is None:
+        representation = {"elements": [cleanLabel(x, maxLabelLength)
+                                       for x in treeData["elements"]]}
+    else:
+        # the parser already left out blank labels
+        representation = {"nodes": {index: cleanLabel(label, maxLabelLength)
+                                    for index, label in tree.nodes.items()}}
+    if "palette" in treeData:
+        representation["palette"] = normalizePalette(treeData["palette"])
+    return representation | {
+        "squares": treeData["squares"],
+        "squaresBlack": treeData.get("squaresBlack", True),
+        "bg": treeData["bg"],
+        "compact": treeData.get("compact", False)
+    }
+
+
+def getCacheKey(options: dict, outputFormat: str, scale: float = PNG_SCALE,
+                directPNG: bool = False) -> str:
+    """Identifies the drawing of a tree with the given normalized options in the
+    given format ("svg" or "png", where scale and directPNG only matter for the
+    latter). PNGs drawn straight from the layout (see renderPNG) can differ from
+    CairoSVG's in their antialiasing, so they get keys of their own."""
+    key = options | {
+        "format": outputFormat,
+        "scale": scale if outputFormat == "png" else 1,
+        "version": RENDER_VERSION
+    }
+    if directPNG and outputFormat == "png":
+        key["renderer"] = "direct"
+    return RenderCache.getKey(key)
+
+
+def optionsToLayout(options: dict, timer: Optional[StageTimer] = None) -> tuple:
+    """Parses the tree's labels and lays it out with nodes big enough for them.
+    Returns the TreeLayout along with the LabelTable to draw it with."""
+    timer = timer or StageTimer()
+    tree = treeFromOptions(options)
+    with timer.stage("labels"):
+        labels = LabelTable.fromLabels(tree.getLabels(), options.get("palette"))
+    with timer.stage("layout"):
+        layout = layoutBinaryTree(tree, options["squares"], options["compact"],
+                                  nodeRadius=labels.nodeRadius)
+    return layout, labels
+
+
+def optionsToSVG(options: dict, timer: Optional[StageTimer] = None) -> SVGElement:
+    """Does what artist.visualizeTreeSpec does, timing the layout and the drawing
+    separately."""
+    timer = timer or StageTimer()
+    layout, labels = optionsToLayout(options, timer)
+    with timer.stage("draw"):
+        return drawTreeLayout(layout, options["squaresBlack"], options["bg"], False,
+                              labels)
+
+
+def iterSVGResponse(svg: SVGElement,
+                    timer: Optional[StageTimer] = None) -> Iterator[bytes]:
+    """Yields the JSON that /svg responds with, which gives the width of the SVG and
+    a data URL containing it. The percent-encoded SVG only contains URL-safe
+    characters, so it can be put into the JSON string as it is produced without any
+    escaping."""
+    timer = timer or StageTimer()
+    yield ('{"width": ' + json.dumps(svg.viewBoxWidth) +
+           ', "url": "data:image/svg+xml,').encode("utf-8")
+    chunks = svg.iterChunks(compact=True)
+    while True:
+        with timer.stage("serialize"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with timer.stage("quote"):
+            quoted = parse.quote(chunk).encode("utf-8")
+        yield quoted
+    yield b'"}'
+
+
+def renderSVGResponse(options: dict, timer: Optional[StageTimer] = None,
+                      limits: Optional[TreeLimits] = None) -> bytes:
+    """Returns the JSON that /svg responds with, raising a TreeTooLargeError
+    instead if the SVG has more shapes than limits allow."""
+    svg = optionsToSVG(options, timer)
+    checkSVGShapes(svg.countShapes(), limits)
+    return b"".join(iterSVGResponse(svg, timer))
+
+
+def svgToPNG(svg: SVGElement, scale: float = PNG_SCALE,
+             timer: Optional[StageTimer] = None,
+             limits: Optional[TreeLimits] = None) -> bytes:
+    """Rasterizes the SVG with CairoSVG, unless the PNG would be bigger than limits
+    allow (or bigger than cairo can handle), in which case a TreeTooLargeError is
+    raised. This is how PNGs are drawn unless optionsToPNG is asked for."""
+    from cairosvg import svg2png
+    timer = timer or StageTimer()
+    checkPNGSize(svg.viewBoxWidth, svg.viewBoxHeight, scale, limits)
+    with timer.stage("serialize"):
+        markup = b"".join(svg.iterChunks(compact=True))
+    with timer.stage("rasterize"):
+        return svg2png(bytestring=markup, output_width=svg.viewBoxWidth*scale)
+
+
+def optionsToPNG(options: dict, scale: float = PNG_SCALE,
+                 timer: Optional[StageTimer] = None,
+                 limits: Optional[TreeLimits] = None) -> bytes:
+    """Lays out the tree and draws it straight into a PNG with raster.layoutToPNG,
+    skipping the SVG altogether, and raises a TreeTooLargeError like svgToPNG does.
+    Its output hasn't been checked against CairoSVG's yet (see raster.py's test),
+    so it is only used when asked for."""
+    from raster import layoutToPNG
+    timer = timer or StageTimer()
+    layout, labels = optionsToLayout(options, timer)
+    checkPNGSize(layout.width, layout.height, scale, limits)
+    with timer.stage("rasterize"):
+        return layoutToPNG(layout, options["squaresBlack"], options["bg"], scale,
+                           labels)
+
+
+def renderPNG(options: dict, timer: Optional[StageTimer] = None,
+              limits: Optional[TreeLimits] = None, directPNG: bool = False) -> bytes:
+    """Draws the PNG that /png responds with, through CairoSVG unless directPNG is
+    True, in which case optionsToPNG draws it."""
+    if directPNG:
+        return optionsToPNG(options, PNG_SCALE, timer, limits)
+    return svgToPNG(optionsToSVG(options, timer), PNG_SCALE, timer, limits)
+
+
+def renderWithTimings(function, options: dict, *args) -> tuple:
+    """Calls one of the functions above that take options and a StageTimer (and
+    maybe more arguments), and returns what it returns along with the time it
+    spent on each stage, so that the timings can make it back from a worker
+    process."""
+    timer = StageTimer()
+    return function(options, timer, *args), timer.seconds
+
+
+def warmUp(withPNG: bool = True, directPNG: bool = False) -> dict:
+    """Draws WARM_UP_OPTIONS as an SVG response and, if withPNG is True, as a PNG
+    (with the rasterizer that directPNG picks, like renderPNG), so that the
+    modules, fonts and caches that drawing needs are loaded before the first real
+    request comes in. Returns the time spent on each stage, with importing the
+    rasterizer as "import"."""
+    timer = StageTimer()
+    renderSVGResponse(WARM_UP_OPTIONS, timer)
+    if withPNG:
+        with timer.stage("import"):
+            if directPNG:
+                import raster  # noqa: F401
+            else:
+                import cairosvg  # noqa: F401
+        renderPNG(WARM_UP_OPTIONS, timer, None, directPNG)
+    return timer.seconds
@@ -1,80 +1,711 @@
+import argparse
+import asyncio
+import functools
+import io
 import json
+import os
+import random
+import signal
+import sys
+import time
+import zipfile
 from typing import Union
 from svg import SVGElement
-import tornado.ioloop
+import tornado.httpserver
+import tornado.netutil
 import tornado.web
-from urllib import parse
 import logging
-from cairosvg import svg2png
-from artist import visualizeBinaryTree
-from tree import ListBasedBinaryTree
+from cache import RenderCache
+from incremental import DrawingHistory, renderEditResponse
+from limits import (TreeLimits, TreeSpecScanner, TreeTooLargeError, checkSVGShapes,
+                    checkTreeLimits)
+from metrics import ServerMetrics, StageTimer
+from pool import RenderPool, RenderPoolFullError
+from tree import treeFromOptions
+from rendering import (PNG_SCALE, getCacheKey, normalizeTreeSpec, optionsToSVG,
+                       iterSVGResponse, renderSVGResponse, renderPNG,
+                       renderWithTimings, warmUp)
 
 
+# the most trees that one request to /batch can ask for
+MAX_BATCH_TREES = 500
+# SVGs of trees with more nodes than this are drawn in the render pool, if there is
+# one, so that they don't hold up everything else
+POOL_SVG_MIN_NODES = 1000
+
+
+@tornado.web.stream_request_body
 class ElementsHandler(tornado.web.RequestHandler):
-    def requestToSVG(self) -> Union[SVGElement, None]:
-        if len(self.request.body) > 500:
-            self.set_status(400, "request too long")
-            self.finish()
-            logging.debug("denied request for being "+str(len(self.request.body))+" bytes long")
+    """The base of the handlers that draw trees. Request bodies are read as they
+    arrive and checked against the server's TreeLimits along the way, so that a
+    body that is too big is turned away without being read in full."""
+    # subclasses describe what they respond with, since that is part of what
+    # identifies a response in the cache
+    outputFormat = None
+    contentType = None
+    # what requests to this handler are called in metrics and logs
+    name = None
+    # how many of these requests this process is in the middle of, so that shutting
+    # down can wait for them, and whether this one is still counted there. a request
+    # stops being counted when it finishes or when its client goes away, whichever
+    # comes first, since Tornado doesn't call on_finish in the latter case
+    activeRequests = 0
+    isActive = False
+
+    def prepare(self):
+        ElementsHandler.activeRequests += 1
+        self.isActive = True
+        self.startTime = time.perf_counter()
+        self.timer = StageTimer()
+        self.responseBytes = 0
+        # anything else worth putting in this request's log entry
+        self.logDetails = {}
+        self.bodyChunks = []
+        self.bodySize = 0
+        self.scanner = self.makeScanner()
+        contentLength = self.request.headers.get("Content-Length", "")
+        if contentLength.isdigit() and int(contentLength) > self.maxBodyBytes:
+            self.deny(413, "request too long")
+
+    @property
+    def limits(self) -> TreeLimits:
+        return self.application.settings.get("tree_limits") or TreeLimits()
+
+    @property
+    def maxBodyBytes(self) -> int:
+        return self.limits.maxBodyBytes
+
+    @property
+    def directPNG(self) -> bool:
+        return self.application.settings.get("direct_png", False)
+
+    def makeScanner(self) -> Union[TreeSpecScanner, None]:
+        return TreeSpecScanner(self.limits)
+
+    def data_received(self, chunk: bytes):
+        if self._finished:
+            # the request was turned away and the rest of it doesn't matter
+            return
+        self.bodyChunks.append(chunk)
+        self.bodySize += len(chunk)
+        try:
+            with self.timer.stage("scan"):
+                if self.scanner is not None:
+                    self.scanner.feed(chunk)
+                elif self.bodySize > self.maxBodyBytes:
+                    raise TreeTooLargeError("request too long")
+        except TreeTooLargeError as e:
+            self.deny(413, str(e))
+        except ValueError as e:
+            self.deny(400, str(e))
+
+    @property
+    def body(self) -> bytes:
+        if len(self.bodyChunks) != 1:
+            self.bodyChunks = [b"".join(self.bodyChunks)]
+        return self.bodyChunks[0]
+
+    def write(self, chunk):
+        if type(chunk) is bytes or type(chunk) is str:
+            self.responseBytes += len(chunk)
+        super().write(chunk)
+
+    def markDone(self):
+        if self.isActive:
+            self.isActive = False
+            ElementsHandler.activeRequests -= 1
+
+    def on_connection_close(self):
+        self.markDone()
+        super().on_connection_close()
+
+    def on_finish(self):
+        self.markDone()
+        seconds = time.perf_counter() - self.startTime
+        status = self.get_status()
+        metrics = self.application.settings.get("metrics")
+        if metrics is not None:
+            metrics.observeRequest(self.name, status, seconds,
+                                   self.bodySize, self.responseBytes,
+                                   self.timer.seconds)
+        # logging every request would cost about as much as handling some of them,
+        # so only a sample of them are, along with every server error
+        if status >= 500 or random.random() < self.application.settings.get(
+                "log_sample_rate", 1):
+            logging.info(json.dumps({
+                "handler": self.name, "status": status,
+                "ms": round(seconds * 1000, 3),
+                "requestBytes": self.bodySize,
+                "responseBytes": self.responseBytes,
+                "stagesMs": {stage: round(value * 1000, 3)
+                             for stage, value in self.timer.seconds.items()}
+            } | self.logDetails))
+
+    def deny(self, status: int, reason: str):
+        """Turns the request away, noting why in its log entry."""
+        self.logDetails["reason"] = reason
+        self.set_status(status, reason)
+        self.finish()
+
+    def parseRequest(self) -> Union[dict, None]:
+        """Checks the request body and returns the normalized options that the tree
+        will be drawn with. If the request is no good, it is rejected and None is
+        returned."""
+        if self._finished:
             return None
         try:
-            treeData = json.loads(self.request.body)
+            with self.timer.stage("parse"):
+                treeData = json.loads(self.body)
         except:
-            self.set_status(400, "invalid JSON")
-            self.finish()
-            logging.debug("denied request for being invalid JSON")
+            self.deny(400, "invalid JSON")
             return None
-        if "elements" not in treeData or type(
-                treeData["elements"]) is not list or "squares" not in treeData or type(
-                treeData["squares"]) is not bool or "bg" not in treeData or type(
-                treeData["bg"]) is not bool:
-            self.set_status(400, "malformed request")
+        try:
+            with self.timer.stage("normalize"):
+                options = normalizeTreeSpec(treeData,
+                                            maxHeight=self.limits.maxHeight)
+                checkTreeLimits(options, self.limits,
+                                PNG_SCALE if self.outputFormat == "png" else None)
+        except TreeTooLargeError as e:
+            self.deny(413, str(e))
+            return None
+        except ValueError:
+            self.deny(400, "malformed request")
+            return None
+        self.logDetails["nodes"] = treeFromOptions(options).countNodes()
+        self.treeData = treeData
+        return options
+
+    def requestToSVG(self) -> Union[SVGElement, None]:
+        options = self.parseRequest()
+        return optionsToSVG(options, self.timer) if options is not None else None
+
+    @property
+    def renderCache(self) -> Union[RenderCache, None]:
+        return self.application.settings.get("render_cache")
+
+    def finishFromCache(self, options: dict) -> bool:
+        """Tags the response with an ETag that identifies its contents, and then
+        finishes the request if the client already has those contents or if they
+        are in the render cache. Returns whether the request was finished."""
+        # finishing the request logs it, so the lookup is timed on its own
+        with self.timer.stage("cache"):
+            self.cacheKey = getCacheKey(options, self.outputFormat,
+                                        directPNG=self.directPNG)
+            self.set_header("Etag", '"' + self.cacheKey + '"')
+            clientHasIt = self.check_etag_header()
+            body = None
+            if not clientHasIt and self.renderCache is not None:
+                body = self.renderCache.get(self.cacheKey)
+        if clientHasIt:
+            self.logDetails["cache"] = "etag"
+            self.set_status(304)
             self.finish()
-            logging.debug("denied request for having malformed input: "+str(treeData))
+            return True
+        if body is not None:
+            self.logDetails["cache"] = "hit"
+            self.set_header("Content-Type", self.contentType)
+            self.finish(body)
+            return True
+        self.logDetails["cache"] = "miss"
+        return False
+
+    async def runRenderer(self, function, options: dict, *args):
+        """Runs function(options, self.timer, *args) in the render pool, if there
+        is one, or right here if there isn't. In the pool, the time spent waiting
+        for a process and sending things back and forth is timed as the "pool"
+        stage. If the pool is too backed up to take the job, or the drawing turns
+        out to be too big, the request is turned away and None is returned."""
+        renderPool = self.application.settings.get("render_pool")
+        try:
+            if renderPool is None:
+                return function(options, self.timer, *args)
+            start = time.perf_counter()
+            result, seconds = await renderPool.run(
+                renderWithTimings, function, options, *args)
+        except RenderPoolFullError:
+            self.set_header("Retry-After", "1")
+            self.deny(503, "server busy")
             return None
-        elements = [(x.strip()[:10] if x.strip() != "" else None)
-                    for x in treeData["elements"]]
-        svgResult = visualizeBinaryTree(
-            ListBasedBinaryTree(elements),
-            treeData["squares"],
-            treeData["squaresBlack"],
-            treeData["bg"])
-        logging.info("processed request for tree: "+str(treeData))
-        return svgResult
+        except TreeTooLargeError as e:
+            self.deny(413, str(e))
+            return None
+        self.timer.merge(seconds)
+        self.timer.add("pool", time.perf_counter() - start - sum(seconds.values()))
+        return result
+
+    def storeInCache(self, body: bytes):
+        if self.renderCache is not None:
+            self.renderCache.put(self.cacheKey, body)
 
 
 class SVGHandler(ElementsHandler):
+    outputFormat = "svg"
+    contentType = "application/json"
+    name = "svg"
 
-    def post(self):
-        svg = super().requestToSVG()
-        if svg is not None:
-            dataURL = "data:image/svg+xml," + parse.quote(svg.render())
-            self.set_header("Content-Type", "application/json")
-            self.finish({"width": svg.viewBoxWidth, "url": dataURL})
+    async def post(self):
+        options = self.parseRequest()
+        if options is None or self.finishFromCache(options):
+            return
+        renderPool = self.application.settings.get("render_pool")
+        if self.application.settings.get("svg_in_pool") or (
+                renderPool is not None and
+                self.logDetails["nodes"] > POOL_SVG_MIN_NODES):
+            body = await self.runRenderer(renderSVGResponse, options, self.limits)
+            if body is not None:
+                self.set_header("Content-Type", self.contentType)
+                self.finish(body)
+                self.storeInCache(body)
+            return
+        svg = optionsToSVG(options, self.timer)
+        try:
+            checkSVGShapes(svg.countShapes(), self.limits)
+        except TreeTooLargeError as e:
+            self.deny(413, str(e))
+            return
+        self.set_header("Content-Type", self.contentType)
+        # the response is streamed out as it is produced; the pieces are also kept
+        # for the cache, if there is one
+        keep = self.renderCache is not None
+        body = []
+        for piece in iterSVGResponse(svg, self.timer):
+            self.write(piece)
+            if keep:
+                body.append(piece)
+            await self.flush()
+        self.finish()
+        if keep:
+            self.storeInCache(b"".join(body))
 
 
 class PNGHandler(ElementsHandler):
+    outputFormat = "png"
+    contentType = "image/png"
+    name = "png"
 
-    def post(self):
-        svg = super().requestToSVG()
-        if svg is not None:
-            png = svg2png(bytestring=svg.render(), output_width=svg.viewBoxWidth*2)
-            self.set_header("Content-Type", "image/png")
+    async def post(self):
+        options = self.parseRequest()
+        if options is None or self.finishFromCache(options):
+            return
+        png = await self.runRenderer(renderPNG, options, self.limits,
+                                     self.directPNG)
+        if png is not None:
+            self.set_header("Content-Type", self.contentType)
             self.finish(png)
+            self.storeInCache(png)
 
 
-if __name__ == "__main__":
-    application = tornado.web.Application([(r"/svg", SVGHandler),
-                                           (r"/png", PNGHandler),
-                                           (r"/(.*)",
-                                            tornado.web.StaticFileHandler, {
-                                                "path": "./static/",
-                                                "default_filename": "index.html"
-                                            })],
-                                          compress_response=True)
-    application.listen(8888)
-    print("listening on port 8888")
+class EditHandler(ElementsHandler):
+    """Draws trees for the editor in the frontend, which keeps its drawing in the
+    page and patches it. Requests are like the ones /svg takes, with an optional
+    "base" that is the "key" of the drawing the client is showing; if this process
+    still has that drawing, only the shapes that changed are sent back. See
+    incremental.renderEditResponse for the response. Drawings are remembered per
+    process, so with several workers, some edits get the whole SVG back."""
+    contentType = "application/json"
+    name = "edit"
+
+    def post(self):
+        options = self.parseRequest()
+        if options is None:
+            return
+        baseKey = self.treeData.get("base")
+        try:
+            with self.timer.stage("edit"):
+                body = renderEditResponse(
+                    options, self.application.settings.get("drawing_history"),
+                    baseKey if type(baseKey) is str else None, self.limits)
+        except TreeTooLargeError as e:
+            self.deny(413, str(e))
+            return
+        self.set_header("Content-Type", self.contentType)
+        self.finish(body)
+
+
+class BatchHandler(ElementsHandler):
+    """Draws many trees in one request. The body is a JSON object with a "trees"
+    list of the same specs that /svg and /png accept, and an optional "format" of
+    "svg" (the default) or "png". SVGs are streamed back as newline-delimited JSON in
+    the order they finish, with each line holding the "index" of its tree and either
+    the "result" that /svg would have given or an "error". PNGs are sent back as a
+    zip file of tree-<index>.png files, along with an errors.json file mapping the
+    indices of any trees that couldn't be drawn to what went wrong. The stages of
+    every tree are timed together. The body as a whole is only bounded by
+    maxBatchBytes, and each tree is checked against the other limits on its own."""
+    name = "batch"
+
+    @property
+    def maxBodyBytes(self) -> int:
+        return self.limits.maxBatchBytes
+
+    def makeScanner(self) -> None:
+        return None
+
+    async def post(self):
+        batch = self.parseBatch()
+        if batch is None:
+            return
+        outputFormat, specs = batch
+        limits = self.limits
+        if outputFormat == "svg":
+            renderer, extraArgs, pngScale = renderSVGResponse, (limits,), None
+        else:
+            renderer, extraArgs, pngScale = (renderPNG, (limits, self.directPNG),
+                                             PNG_SCALE)
+        renderPool = self.application.settings.get("render_pool")
+        # each batch only gets as many renders going at once as there are worker
+        # processes, so that it doesn't crowd out everyone else
+        slots = asyncio.Semaphore(renderPool.processes if renderPool else 1)
+
+        async def renderItem(index: int, spec):
+            try:
+                with self.timer.stage("normalize"):
+                    options = normalizeTreeSpec(spec, maxHeight=limits.maxHeight)
+                    checkTreeLimits(options, limits, pngScale)
+            except ValueError as e:
+                return index, None, str(e)
+            with self.timer.stage("cache"):
+                key = getCacheKey(options, outputFormat,
+                                  directPNG=self.directPNG)
+                if self.renderCache is not None:
+                    body = self.renderCache.get(key)
+                    if body is not None:
+                        return index, body, None
+            async with slots:
+                try:
+                    if renderPool is None:
+                        body = renderer(options, self.timer, *extraArgs)
+                    else:
+                        start = time.perf_counter()
+                        body, seconds = await renderPool.run(
+                            renderWithTimings, renderer, options, *extraArgs,
+                            wait=True)
+                        self.timer.merge(seconds)
+                        self.timer.add("pool", time.perf_counter() - start -
+                                       sum(seconds.values()))
+                except TreeTooLargeError as e:
+                    return index, None, str(e)
+                except Exception as e:
+                    logging.debug(f"batch item {index} failed: {e!r}")
+                    return index, None, "could not render tree: " + str(e)
+            if self.renderCache is not None:
+                self.renderCache.put(key, body)
+            return index, body, None
+
+        results = asyncio.as_completed(
+            [renderItem(i, spec) for i, spec in enumerate(specs)])
+        if outputFormat == "svg":
+            self.set_header("Content-Type", "application/x-ndjson")
+            for result in results:
+                index, body, error = await result
+                if error is None:
+                    self.write(b'{"index": %d, "result": %b}\n' % (index, body))
+                else:
+                    self.write(json.dumps({"index": index, "error": error}) + "\n")
+                await self.flush()
+            self.finish()
+        else:
+            archive = io.BytesIO()
+            errors = {}
+            # PNGs are already compressed, so there's no point in deflating them
+            with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zipped:
+                for result in results:
+                    index, body, error = await result
+                    if error is None:
+                        zipped.writestr(f"tree-{index}.png", body)
+                    else:
+                        errors[index] = error
+                if errors:
+                    zipped.writestr("errors.json", json.dumps(errors))
+            self.set_header("Content-Type", "application/zip")
+            self.set_header("Content-Disposition",
+                            'attachment; filename="trees.zip"')
+            self.finish(archive.getvalue())
+
+    def parseBatch(self) -> Union[tuple, None]:
+        """Checks the outer structure of a batch request and returns its format and
+        list of tree specs; the specs themselves are checked one at a time, so that
+        a bad one only spoils its own result."""
+        if self._finished:
+            return None
+        try:
+            with self.timer.stage("parse"):
+                batchData = json.loads(self.body)
+        except:
+            self.deny(400, "invalid JSON")
+            return None
+        if type(batchData) is not dict or type(batchData.get("trees")) is not list \
+                or batchData.get("format", "svg") not in ("svg", "png"):
+            self.deny(400, "malformed request")
+            return None
+        if len(batchData["trees"]) > MAX_BATCH_TREES:
+            self.deny(400, "too many trees")
+            return None
+        self.logDetails["trees"] = len(batchData["trees"])
+        return batchData.get("format", "svg"), batchData["trees"]
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Reports this process's metrics in the Prometheus text format."""
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(self.application.settings["metrics"].render())
+
+
+def logAccess(handler: tornado.web.RequestHandler):
+    """Stands in for Tornado's access log, which would log every request; the
+    ones that ElementsHandler already logs a sample of are left out."""
+    if isinstance(handler, ElementsHandler):
+        return
+    status = handler.get_status()
+    logging.log(logging.WARNING if status >= 400 else logging.DEBUG,
+                f"{status} {handler.request.method} {handler.request.uri} "
+                f"{handler.request.request_time() * 1000:.2f}ms")
+
+
+def makeApplication(**settings) -> tornado.web.Application:
+    settings.setdefault("log_function", logAccess)
+    if "metrics" not in settings:
+        settings["metrics"] = ServerMetrics(
+            settings.get("render_cache"), settings.get("render_pool"),
+            lambda: ElementsHandler.activeRequests)
+    return tornado.web.Application([(r"/svg", SVGHandler),
+                                    (r"/png", PNGHandler),
+                                    (r"/edit", EditHandler),
+                                    (r"/batch", BatchHandler),
+                                    (r"/metrics", MetricsHandler),
+                                    (r"/(.*)",
+                                     tornado.web.StaticFileHandler, {
+                                         "path": "./static/",
+                                         "default_filename": "index.html"
+                                     })],
+                                   compress_response=True,
+                                   **settings)
+
+
+def parseArguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serves the tree drawer.")
+    parser.add_argument("--address", default="",
+                        help="address to listen on (defaults to all interfaces)")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="how many server processes to fork (0 for one per core)")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="give each worker its own SO_REUSEPORT socket instead "
+                        "of sharing one bound before forking")
+    parser.add_argument("--idle-timeout", type=float, default=3600,
+                        help="seconds to keep idle keep-alive connections open")
+    parser.add_argument("--no-keep-alive", action="store_true",
+                        help="close every connection after one request")
+    parser.add_argument("--drain-timeout", type=float, default=30,
+                        help="seconds to let in-flight requests finish after SIGTERM")
+    parser.add_argument("--cache-entries", type=int, default=1000,
+                        help="how many rendered responses to keep (0 to disable)")
+    parser.add_argument("--cache-megabytes", type=float, default=64,
+                        help="how much memory rendered responses can take up")
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory to keep rendered responses in across restarts")
+    parser.add_argument("--edit-history", type=int, default=100,
+                        help="how many drawings to remember for sending patches to "
+                        "the editor instead of whole drawings (0 to disable)")
+    parser.add_argument("--render-processes", type=int, default=None,
+                        help="how many processes each worker renders PNGs in "
+                        "(defaults to splitting the cores between the workers; 0 "
+                        "renders on the main thread)")
+    parser.add_argument("--render-queue", type=int, default=32,
+                        help="how many renders can wait for a free process before "
+                        "requests are turned away")
+    parser.add_argument("--svg-in-pool", action="store_true",
+                        help="render SVGs in the worker processes too")
+    parser.add_argument("--direct-png", action="store_true",
+                        help="draw PNGs straight from the layout instead of "
+                        "through CairoSVG")
+    parser.add_argument("--log-sample-rate", type=float, default=0.01,
+                        help="fraction of requests to log (server errors are "
+                        "always logged)")
+    defaults = TreeLimits()
+    parser.add_argument("--max-body-bytes", type=int, default=defaults.maxBodyBytes,
+                        help="longest request body for one tree")
+    parser.add_argument("--max-batch-bytes", type=int,
+                        default=defaults.maxBatchBytes,
+                        help="longest request body for /batch")
+    parser.add_argument("--max-nodes", type=int, default=defaults.maxNodes,
+                        help="most nodes that a tree can have")
+    parser.add_argument("--max-height", type=int, default=defaults.maxHeight,
+                        help="most levels that a tree can have")
+    parser.add_argument("--max-png-pixels", type=int,
+                        default=defaults.maxPNGPixels,
+                        help="largest PNG that will be drawn, in pixels")
+    parser.add_argument("--max-svg-shapes", type=int,
+                        default=defaults.maxSVGShapes,
+                        help="most shapes that an SVG that is sent can have")
+    parser.add_argument("--no-warm-up", action="store_true",
+                        help="start taking requests without drawing a sample tree "
+                        "in each process first")
+    return parser.parse_args()
+
+
+def forkWorkers(count: int) -> bool:
+    """Forks count worker processes and returns True in each of them. The original
+    process stays in here, restarting workers that crash and passing SIGTERM and
+    SIGINT on to the workers so that they can shut down gracefully; it exits once
+    they have all stopped."""
+    children = set()
+    stopping = False
+
+    def forwardSignal(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def startWorker() -> bool:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            return True
+        children.add(pid)
+        return False
+
+    # the handlers are installed before forking so that there is no moment where a
+    # signal could kill this process without reaching the workers
+    signal.signal(signal.SIGTERM, forwardSignal)
+    signal.signal(signal.SIGINT, forwardSignal)
+    for _ in range(count):
+        if startWorker():
+            return True
+    while children:
+        pid, status = os.wait()
+        children.discard(pid)
+        if not stopping and os.waitstatus_to_exitcode(status) != 0:
+            logging.warning(f"worker {pid} exited with status {status}; restarting")
+            if startWorker():
+                return True
+    sys.exit(0)
+
+
+async def shutDown(server: tornado.httpserver.HTTPServer,
+                   renderPool: Union[RenderPool, None], drainTimeout: float):
+    """Stops accepting connections, gives the requests that are being handled
+    drainTimeout seconds to finish, and then closes everything."""
+    server.stop()
+    deadline = time.monotonic() + drainTimeout
+    while ElementsHandler.activeRequests > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    try:
+        await asyncio.wait_for(server.close_all_connections(),
+                               max(0, deadline - time.monotonic()) + 1)
+    except asyncio.TimeoutError:
+        logging.warning("gave up on closing connections gracefully")
+    if renderPool is not None:
+        renderPool.shutdown()
+
+
+async def warmUpProcess(renderPool: Union[RenderPool, None],
+                        metrics: ServerMetrics, directPNG: bool = False):
+    """Draws a sample tree in this process and in every process of its render pool,
+    if it has one, so that none of them have to load anything while handling the
+    first requests. This process only draws a PNG (with the rasterizer that
+    directPNG picks) if there is no pool to do it. How long it took is logged and
+    put into metrics.startupSeconds."""
+    start = time.perf_counter()
+    if renderPool is not None:
+        for pid, seconds, error in await renderPool.start():
+            if error is not None:
+                logging.warning(f"render process {pid} couldn't warm up: {error}")
+            else:
+                logging.info(f"render process {pid} warmed up in "
+                             f"{sum(seconds.values()) * 1000:.1f}ms")
+        metrics.startupSeconds["pool"] = time.perf_counter() - start
+    processStart = time.perf_counter()
+    try:
+        seconds = warmUp(withPNG=renderPool is None, directPNG=directPNG)
+        metrics.startupSeconds.update(seconds)
+    except Exception as e:
+        logging.warning(f"process {os.getpid()} couldn't warm up: {e!r}")
+    metrics.startupSeconds["process"] = time.perf_counter() - processStart
+    metrics.startupSeconds["total"] = time.perf_counter() - start
+    logging.info(f"process {os.getpid()} warmed up in "
+                 f"{metrics.startupSeconds['total'] * 1000:.1f}ms")
+
+
+async def serve(arguments: argparse.Namespace, sockets: Union[list, None],
+                workerCount: int):
+    """Runs one server process until it is sent SIGTERM or SIGINT. If sockets is
+    None, the process binds its own."""
+    renderCache = None
+    if arguments.cache_entries > 0:
+        renderCache = RenderCache(arguments.cache_entries,
+                                  int(arguments.cache_megabytes * 2**20),
+                                  arguments.cache_dir)
+    renderProcesses = arguments.render_processes
+    if renderProcesses is None:
+        renderProcesses = max(1, (os.cpu_count() or 1) // workerCount)
+    renderPool = None
+    if renderProcesses != 0:
+        renderPool = RenderPool(renderProcesses, arguments.render_queue,
+                                None if arguments.no_warm_up else
+                                functools.partial(warmUp,
+                                                  directPNG=arguments.direct_png))
+    limits = TreeLimits(maxBodyBytes=arguments.max_body_bytes,
+                        maxBatchBytes=arguments.max_batch_bytes,
+                        maxNodes=arguments.max_nodes,
+                        maxHeight=arguments.max_height,
+                        maxPNGPixels=arguments.max_png_pixels,
+                        maxSVGShapes=arguments.max_svg_shapes)
+    application = makeApplication(render_cache=renderCache,
+                                  render_pool=renderPool,
+                                  drawing_history=DrawingHistory(
+                                      arguments.edit_history),
+                                  svg_in_pool=arguments.svg_in_pool,
+                                  direct_png=arguments.direct_png,
+                                  log_sample_rate=arguments.log_sample_rate,
+                                  tree_limits=limits)
+    if not arguments.no_warm_up:
+        # this comes before binding so that, with SO_REUSEPORT, connections aren't
+        # sent to this process until it is ready for them
+        await warmUpProcess(renderPool, application.settings["metrics"],
+                            arguments.direct_png)
+    server = tornado.httpserver.HTTPServer(
+        application,
+        max_body_size=max(limits.maxBodyBytes, limits.maxBatchBytes),
+        no_keep_alive=arguments.no_keep_alive,
+        idle_connection_timeout=arguments.idle_timeout)
+    if sockets is None:
+        sockets = tornado.netutil.bind_sockets(
+            arguments.port, arguments.address, reuse_port=True)
+    server.add_sockets(sockets)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+    logging.info(f"process {os.getpid()} shutting down")
+    await shutDown(server, renderPool, arguments.drain_timeout)
+
+
+def main():
+    arguments = parseArguments()
     logging.basicConfig(
         filename='requests.log', encoding='utf-8', level=logging.DEBUG,
         format='%(asctime)s: %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
-    tornado.ioloop.IOLoop.current().start()
+    workerCount = arguments.workers or os.cpu_count() or 1
+    # the shared socket has to be bound before forking so that every worker gets
+    # it; with SO_REUSEPORT, each worker binds its own afterwards instead
+    sockets = None
+    if not arguments.reuse_port:
+        sockets = tornado.netutil.bind_sockets(arguments.port, arguments.address)
+    print(f"listening on port {arguments.port} with {workerCount} worker(s)")
+    if workerCount > 1:
+        forkWorkers(workerCount)
+    asyncio.run(serve(arguments, sockets, workerCount))
+
+
+if __name__ == "__main__":
+    main()
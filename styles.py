@@ -0,0 +1,235 @@
+"""How node labels are styled and how much room they need. A label can start with a
+color marker like $red, which is looked up in a palette that gives the fill of the
+node's shape and of its text, and the rest of the label is its text, which is
+measured with a table of the glyph widths of the font it is drawn in so that
+nodes can be made big enough to hold it.
+
+Labels are parsed into a LabelTable once per drawing, before any shapes are made,
+and each distinct label is only parsed and measured once, however many nodes
+share it; drawing a node is then a couple of lookups."""
+import math
+import re
+import unicodedata
+from typing import Iterable, Optional
+from layout import NODE_RADIUS
+
+NODE_TEXT_SIZE = 20
+NODE_FONT_FAMILY = "LiberationSans, sans-serif"
+
+# the RGB values of the color names that palettes can use, besides #rgb and
+# #rrggbb; these are the SVG and CSS colors of the same names
+NAMED_COLORS = {
+    "white": (255, 255, 255),
+    "black": (0, 0, 0),
+    "red": (255, 0, 0),
+    "green": (0, 128, 0),
+    "blue": (0, 0, 255),
+    "yellow": (255, 255, 0),
+    "orange": (255, 165, 0),
+    "purple": (128, 0, 128),
+    "pink": (255, 192, 203),
+    "gray": (128, 128, 128),
+}
+HEX_COLOR = re.compile(r"#(?:[0-9a-f]{3}){1,2}")
+MARKER_NAME = re.compile(r"[a-z][a-z0-9_-]*")
+MAX_MARKER_NAME_LENGTH = 16
+MAX_PALETTE_ENTRIES = 16
+
+# the advance widths of the printable ASCII characters in Liberation Sans, which
+# has the same metrics as Arial, in thousandths of the font size
+GLYPH_WIDTHS = dict(zip(
+    " !\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`"
+    "abcdefghijklmnopqrstuvwxyz{|}~",
+    (278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278,
+     278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584,
+     584, 556, 1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556,
+     833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278,
+     278, 278, 469, 556, 333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222,
+     500, 222, 833, 556, 556, 556, 556, 333, 500, 278, 556, 500, 722, 500, 500,
+     500, 334, 260, 334, 584)))
+# characters that aren't in the table are guessed at: wide East Asian characters
+# take up a whole em and everything else about as much as a digit. the guesses are
+# added to the table as they are made
+WIDE_GLYPH_WIDTH = 1000
+DEFAULT_GLYPH_WIDTH = 556
+# how far the text of a label reaches above and below its middle, as a fraction of
+# the font size (Liberation Sans's capitals and digits are about 0.72 em tall),
+# and how much room is left between the text and the outline of its node
+TEXT_HALF_HEIGHT = 0.36
+NODE_TEXT_PADDING = 1.5
+
+
+def getGlyphWidth(character: str) -> int:
+    width = GLYPH_WIDTHS.get(character)
+    if width is None:
+        if unicodedata.combining(character):
+            width = 0
+        elif unicodedata.east_asian_width(character) in ("W", "F"):
+            width = WIDE_GLYPH_WIDTH
+        else:
+            width = DEFAULT_GLYPH_WIDTH
+        GLYPH_WIDTHS[character] = width
+    return width
+
+
+def measureText(text: str, fontSize: float = NODE_TEXT_SIZE) -> float:
+    """Returns about how wide text is when drawn at fontSize, going by the advance
+    widths of its characters without kerning."""
+    widths = GLYPH_WIDTHS
+    return sum(widths[c] if c in widths else getGlyphWidth(c)
+               for c in text) * fontSize / 1000
+
+
+def getNodeRadius(textWidth: float) -> int:
+    """Returns the radius that nodes need for text of the given width to fit in
+    their circles, which is never less than layout.NODE_RADIUS."""
+    needed = math.hypot(textWidth / 2, TEXT_HALF_HEIGHT * NODE_TEXT_SIZE)
+    return max(NODE_RADIUS, math.ceil(needed + NODE_TEXT_PADDING))
+
+
+def colorToRGB(color: str) -> tuple:
+    """Returns the red, green and blue of a color name from NAMED_COLORS or a hex
+    color, from 0 to 255."""
+    if color in NAMED_COLORS:
+        return NAMED_COLORS[color]
+    digits = color[1:]
+    if len(digits) == 3:
+        digits = "".join(c * 2 for c in digits)
+    return tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def getTextFill(fill: str) -> Optional[str]:
+    """Returns whichever of black and white text stands out more against fill (as
+    WCAG measures contrast), with black as None, since it's the default."""
+    def getLinear(channel: int) -> float:
+        channel /= 255
+        return (channel / 12.92 if channel <= 0.04045 else
+                ((channel + 0.055) / 1.055) ** 2.4)
+    red, green, blue = map(getLinear, colorToRGB(fill))
+    luminance = 0.2126 * red + 0.7152 * green + 0.0722 * blue
+    return None if (luminance + 0.05) ** 2 >= 0.05 * 1.05 else "white"
+
+
+def normalizeColor(color) -> str:
+    if type(color) is not str:
+        raise ValueError("malformed color")
+    color = color.strip().lower()
+    if color not in NAMED_COLORS and not HEX_COLOR.fullmatch(color):
+        raise ValueError(f"unknown color {color!r}")
+    return color
+
+
+def normalizePalette(palette) -> dict:
+    """Checks a palette like the ones that tree specs can have and returns it in
+    the form that LabelTable takes. A palette maps marker names (lowercase letters,
+    digits, - and _, starting with a letter) to either a fill color, in which case
+    the text is black or white depending on which stands out more, or a list of the
+    fill and text colors. Colors are hex colors or names from NAMED_COLORS. Raises
+    a ValueError if the palette is malformed."""
+    if type(palette) is not dict or len(palette) > MAX_PALETTE_ENTRIES:
+        raise ValueError("malformed palette")
+    result = {}
+    for name, colors in palette.items():
+        if len(name) > MAX_MARKER_NAME_LENGTH or not MARKER_NAME.fullmatch(name):
+            raise ValueError(f"malformed marker name {name!r}")
+        if type(colors) is list and len(colors) == 2:
+            fill = normalizeColor(colors[0])
+            textFill = normalizeColor(colors[1])
+            result[name] = [fill, None if textFill == "black" else textFill]
+        else:
+            fill = normalizeColor(colors)
+            result[name] = [fill, getTextFill(fill)]
+    return result
+
+
+# every named color is a marker of its own, except for white, which is what
+# unmarked nodes look like anyway
+DEFAULT_PALETTE = normalizePalette(
+    {name: name for name in NAMED_COLORS if name != "white"})
+
+
+class LabelTable:
+    """The parsed labels of a drawing. Each distinct label is interned as an entry
+    of (style id, text) in entries, where the style id indexes styles, a list of
+    (shape fill, text fill) pairs in which None means the default (a white shape
+    and black text), and the text is the label without its color marker. The
+    label None, for nodes that don't exist, has the default style and no text.
+    Labels are only marked if they start with $ and the name of one of the
+    palette's markers, which is added to DEFAULT_PALETTE (see normalizePalette);
+    the longest name that fits wins, and whatever follows it, stripped of
+    whitespace, is the text. maxTextWidth is how wide the widest text is."""
+
+    def __init__(self, palette: Optional[dict] = None):
+        self.palette = DEFAULT_PALETTE | (palette or {})
+        names = sorted(self.palette, key=len, reverse=True)
+        self.marker = re.compile(r"\$(" + "|".join(map(re.escape, names)) + ")")
+        self.styles = [(None, None)]
+        self.styleIds = {(None, None): 0}
+        self.entries = {None: (0, None)}
+        self.maxTextWidth = 0.0
+
+    @classmethod
+    def fromLabels(cls, labels: Iterable, palette: Optional[dict] = None):
+        table = cls(palette)
+        table.addLabels(labels)
+        return table
+
+    def addLabels(self, labels: Iterable):
+        entries = self.entries
+        # duplicates are dropped first, keeping the order that labels first
+        # appear in so that style ids don't depend on hashing
+        for label in dict.fromkeys(labels):
+            if label not in entries:
+                self.addLabel(label)
+
+    def addLabel(self, label: str) -> tuple:
+        match = self.marker.match(label)
+        if match is None:
+            style = (None, None)
+            text = label
+        else:
+            style = tuple(self.palette[match.group(1)])
+            text = label[match.end():].strip()
+        styleId = self.styleIds.get(style)
+        if styleId is None:
+            styleId = self.styleIds[style] = len(self.styles)
+            self.styles.append(style)
+        self.maxTextWidth = max(self.maxTextWidth, measureText(text))
+        entry = self.entries[label] = (styleId, text)
+        return entry
+
+    @property
+    def nodeRadius(self) -> int:
+        """The radius that the nodes have to have for every text to fit."""
+        return getNodeRadius(self.maxTextWidth)
+
+
+if __name__ == "__main__":
+    assert getNodeRadius(measureText("100")) == NODE_RADIUS, \
+        "short labels should fit in nodes of the usual size"
+    assert getNodeRadius(measureText("a longer label")) > NODE_RADIUS, \
+        "long labels should get bigger nodes"
+    assert measureText("WW") > measureText("ii"), "glyphs should have their widths"
+    assert measureText("木") == NODE_TEXT_SIZE, \
+        "wide characters should take up an em"
+    assert DEFAULT_PALETTE["red"] == ["red", None] and \
+        DEFAULT_PALETTE["black"] == ["black", "white"], \
+        "the original markers should look like they always did"
+    table = LabelTable.fromLabels(
+        ["$red 1", "$black 2", "3", "$red 1", "$redder 4", "$blue", "$x 5"],
+        normalizePalette({"redder": "#800", "x": ["yellow", "#00f"]}))
+    assert table.entries["$red 1"] == (1, "1") and \
+        table.styles[1] == ("red", None), "markers should be parsed and interned"
+    assert table.entries["$black 2"][1] == "2" and table.entries["3"] == (0, "3")
+    assert table.styles[table.entries["$redder 4"][0]] == ("#800", "white"), \
+        "the longest marker should win, and dark fills should get white text"
+    assert table.styles[table.entries["$x 5"][0]] == ("yellow", "#00f")
+    assert table.entries["$blue"][1] == "", "a marker can be a whole label"
+    assert len(table.styles) == 6, "each style should be interned once"
+    for bad in ({"Red": "red"}, {"red": "chartreuse"}, {"red": ["red"]}, []):
+        try:
+            normalizePalette(bad)
+            assert False, "malformed palettes should be rejected"
+        except ValueError:
+            pass
+    print("tests passed")
@@ -1,17 +1,38 @@
-from typing import Union
+from typing import Iterator, Optional, TextIO, Union
+
+
+def escapeText(text) -> str:
+    """Turns text content, like a node's label, into markup that XML parsers read
+    back as the same text."""
+    return str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def escapeAttr(value) -> str:
+    """Like escapeText, for attribute values in double quotes. Numbers, which
+    most attributes are, are left alone without a look."""
+    if type(value) is not str:
+        return str(value)
+    return escapeText(value).replace('"', "&quot;")
+
+
+def isElement(x) -> bool:
+    """Children can be elements, groups of shapes, or strings representing text
+    nodes; this tells the first two apart from the last."""
+    return isinstance(x, (SVGElement, SVGShapeGroup))
 
 
 class SVGElement:
+    __slots__ = ("tagName", "attrs", "children")
 
     def __init__(self,
                  tagName: str,
-                 attrs: dict[str, str] = {},
-                 children: list = []):
+                 attrs: Optional[dict[str, str]] = None,
+                 children: Optional[list] = None):
         """Sets up the basic ingredients of an SVG element."""
         self.tagName = tagName
-        self.attrs = attrs
+        self.attrs = attrs if attrs is not None else {}
         self.children = [
-            (x if type(x) is type(self) else str(x)) for x in children
+            (x if isElement(x) else str(x)) for x in (children or [])
         ]
 
     def setAttr(self, key: str, value: Union[str, int]):
@@ -34,9 +55,10 @@ class SVGElement:
 
     def addChild(self, child):
         """
-        A child can either be another SVG element or a string representing a text node.
+        A child can either be another SVG element, an SVGShapeGroup, or a string
+        representing a text node.
         """
-        if type(child) is type(self):
+        if isElement(child):
             self.children.append(child)
         else:
             self.children.append(str(child))
@@ -65,16 +87,145 @@ class SVGElement:
                 print("malformed viewbox, attempt to get SVG height failed")
                 return None
 
-    def render(self, depth=0) -> str:
-        tabBase = "    "
-        tab = tabBase * depth
-        renderedChildren = "\n".join(
-            (c.render(depth + 1) if type(c) is type(self) else tabBase *
-             (depth + 1) + c) for c in self.children)
-        renderedAttrs = " ".join(k + f'="{v}"' for k, v in self.attrs.items())
-        return tab + f"<{self.tagName} " + renderedAttrs + (
-            "/>" if len(self.children) == 0 else
-            (">\n" + renderedChildren + f"\n{tab}</{self.tagName}>"))
+    def countShapes(self) -> int:
+        """Counts the children of the SVGShapeGroups in this element, at any depth,
+        which are the shapes of a drawn tree."""
+        return sum(len(c) if type(c) is SVGShapeGroup else c.countShapes()
+                   for c in self.children if isElement(c))
+
+    tabBase = "    "
+
+    def iterRender(self, depth: int = 0, compact: bool = False) -> Iterator[str]:
+        """Yields the markup for this element and its children a piece at a time,
+        without ever building up the whole thing as one string. If compact is True,
+        the indentation and line breaks are left out."""
+        tab = "" if compact else self.tabBase * depth
+        childTab = "" if compact else self.tabBase * (depth + 1)
+        newline = "" if compact else "\n"
+        renderedAttrs = " ".join(k + '="' + escapeAttr(v) + '"'
+                                 for k, v in self.attrs.items())
+        if len(self.children) == 0:
+            yield tab + f"<{self.tagName} " + renderedAttrs + "/>"
+            return
+        yield tab + f"<{self.tagName} " + renderedAttrs + ">" + newline
+        for i, c in enumerate(self.children):
+            if i != 0:
+                yield newline
+            if isElement(c):
+                yield from c.iterRender(depth + 1, compact)
+            else:
+                yield childTab + escapeText(c)
+        yield newline + tab + f"</{self.tagName}>"
+
+    def iterChunks(self, compact: bool = False,
+                   chunkSize: int = 65536) -> Iterator[bytes]:
+        """Yields the UTF-8 encoded markup in chunks of roughly chunkSize bytes, for
+        sending to a client or a file as it is produced."""
+        pieces = []
+        size = 0
+        for piece in self.iterRender(compact=compact):
+            pieces.append(piece)
+            size += len(piece)
+            if size >= chunkSize:
+                yield "".join(pieces).encode("utf-8")
+                pieces = []
+                size = 0
+        if pieces:
+            yield "".join(pieces).encode("utf-8")
+
+    def renderTo(self, stream: TextIO, compact: bool = False):
+        """Writes the markup to a text stream, like an open file."""
+        for piece in self.iterRender(compact=compact):
+            stream.write(piece)
+
+    def render(self, depth: int = 0, compact: bool = False) -> str:
+        return "".join(self.iterRender(depth, compact))
+
+
+class SVGShapeGroup:
+    """A <g> element full of children that all have the same tag name and the same
+    attribute names, like the nodes or edges of a big tree. Instead of being a whole
+    SVGElement with its own attribute dict, each child is just a tuple of attribute
+    values, in the same order as childAttrNames; a value of None leaves that
+    attribute out. Attributes that SVG lets children inherit, like "fill" or
+    "stroke", belong in attrs, and are written once on the group; ones that can't be
+    inherited but are the same for every child, like "r", go in childAttrs. If
+    hasText is True, the last item in each tuple is the child's text content."""
+    __slots__ = ("attrs", "childTagName", "childAttrNames", "childAttrs",
+                 "hasText", "rows")
+    tagName = "g"
+
+    def __init__(self,
+                 childTagName: str,
+                 childAttrNames: tuple,
+                 attrs: Optional[dict] = None,
+                 childAttrs: Optional[dict] = None,
+                 hasText: bool = False):
+        self.childTagName = childTagName
+        self.childAttrNames = childAttrNames
+        self.attrs = attrs if attrs is not None else {}
+        self.childAttrs = childAttrs if childAttrs is not None else {}
+        self.hasText = hasText
+        self.rows = []
+
+    def addShape(self, *values):
+        """Adds a child with the given attribute values (and text, if hasText)."""
+        self.rows.append(values)
+
+    def addShapes(self, *columns):
+        """Adds a child for each position in the given columns, where each column is
+        a sequence holding one attribute's values (or the text, if hasText) for every
+        new child. A column can also be a single value shared by all of them."""
+        count = max((len(c) for c in columns if type(c) is list), default=0)
+        self.rows.extend(zip(*(c if type(c) is list else [c] * count
+                               for c in columns)))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def children(self) -> list:
+        """The children expanded into regular SVGElements, for callers that want to
+        inspect them; this defeats the purpose if the group is large."""
+        return [SVGElement(self.childTagName, self.getChildAttrs(row),
+                           [row[-1]] if self.hasText else [])
+                for row in self.rows]
+
+    def getChildAttrs(self, row: tuple) -> dict:
+        return {k: v for k, v in zip(self.childAttrNames, row)
+                if v is not None} | self.childAttrs
+
+    def iterRender(self, depth: int = 0, compact: bool = False) -> Iterator[str]:
+        """Yields the same markup that an equivalent SVGElement would."""
+        tabBase = SVGElement.tabBase
+        tab = "" if compact else tabBase * depth
+        childTab = "" if compact else tabBase * (depth + 1)
+        textTab = "" if compact else tabBase * (depth + 2)
+        newline = "" if compact else "\n"
+        renderedAttrs = " ".join(k + '="' + escapeAttr(v) + '"'
+                                 for k, v in self.attrs.items())
+        if len(self.rows) == 0:
+            yield tab + "<g " + renderedAttrs + "/>"
+            return
+        yield tab + "<g " + renderedAttrs + ">"
+        opening = newline + childTab + f"<{self.childTagName} "
+        constantAttrs = "".join(" " + k + '="' + escapeAttr(v) + '"'
+                                for k, v in self.childAttrs.items())
+        names = self.childAttrNames
+        for row in self.rows:
+            renderedChildAttrs = " ".join(
+                names[i] + '="' + escapeAttr(row[i]) + '"'
+                for i in range(len(names)) if row[i] is not None) + constantAttrs
+            if self.hasText:
+                yield (opening + renderedChildAttrs + ">" + newline + textTab +
+                       escapeText(row[-1]) + newline + childTab +
+                       f"</{self.childTagName}>")
+            else:
+                yield opening + renderedChildAttrs + "/>"
+        yield newline + tab + "</g>"
+
+    def render(self, depth: int = 0, compact: bool = False) -> str:
+        return "".join(self.iterRender(depth, compact))
 
 
 if __name__ == "__main__":
@@ -87,7 +238,22 @@ if __name__ == "__main__":
         "text", {"x": 0, "y": 70, "font-family": "LiberationSans, sans-serif"},
         ["test text"])
     testCont.addChild(testText)
-    print("circle with text in container:")
+    testGroup = SVGShapeGroup("circle", ("cx", "cy"), {"fill": "blue"}, {"r": 5})
+    testGroup.addShape(10, 10)
+    testGroup.addShape(90, 10)
+    testCont.addChild(testGroup)
+    assert testGroup.render() == SVGElement(
+        "g", testGroup.attrs, testGroup.children).render(), \
+        "shape groups should render like the equivalent elements"
+    textGroup = SVGShapeGroup("text", ("x",), hasText=True)
+    textGroup.addShape('a"b', "<&>")
+    assert textGroup.render(compact=True) == \
+        '<g ><text x="a&quot;b">&lt;&amp;&gt;</text></g>', \
+        "text and attribute values should be escaped"
+    assert textGroup.render() == SVGElement(
+        "g", textGroup.attrs, textGroup.children).render(), \
+        "shape groups should escape like the equivalent elements"
+    print("circle with text and a group of circles in container:")
     print(testCont.render())
     with open("test.svg", "w+", encoding="utf-8") as testFile:
         testFile.write(testCont.render())
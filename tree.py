@@ -1,65 +1,151 @@
-import math
+import re
+from collections.abc import Sequence
+from itertools import chain, repeat
+from typing import Optional
 
 
-class ListBasedBinaryTree:
-    """List-based binary tree that provides the functions that our drawing algorithm
-    will need. The root of the tree is considered to be at level 1."""
+class TreeTooLargeError(ValueError):
+    """Raised for tree specs that are well-formed but exceed a limit on their
+    size."""
+    pass
 
-    def __init__(self, listRepresentation: list):
-        """
-        Initializes a binary tree based on a list. The list should have None values
-        to signify non-existant nodes.
-        """
+
+class LevelView(Sequence):
+    """A read-only window onto the part of a list-based tree's list that holds one
+    of its levels, which doesn't copy anything. It always has as many slots as the
+    level can hold; the ones past the end of the list read as None."""
+    __slots__ = ("list", "start", "length")
+
+    def __init__(self, listRepresentation: list, start: int, length: int):
         self.list = listRepresentation
+        self.start = start
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, i):
+        if type(i) is slice:
+            return [self[j] for j in range(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("level view index out of range")
+        index = self.start + i
+        return self.list[index] if index < len(self.list) else None
+
+    def __iter__(self):
+        end = min(self.start + self.length, len(self.list))
+        stored = max(0, end - self.start)
+        return chain(map(self.list.__getitem__, range(self.start, end)),
+                     repeat(None, self.length - stored))
 
-    @property
-    def height(self) -> int:
-        # can this be turned from log(n) into constant time ??
-        level = 0
-        accumulator = 0
-        while accumulator < len(self.list):
-            accumulator += 2**level
-            level += 1
-        return level
+
+class SparseLevelView(Sequence):
+    """Like LevelView, but for the dict of a SparseBinaryTree: slots are looked up
+    in it as they are read, so a view of a deep level takes no more memory than
+    one of the root's."""
+    __slots__ = ("nodes", "start", "length")
+
+    def __init__(self, nodes: dict, start: int, length: int):
+        self.nodes = nodes
+        self.start = start
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, i):
+        if type(i) is slice:
+            return [self[j] for j in range(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("level view index out of range")
+        return self.nodes.get(self.start + i)
+
+    def __iter__(self):
+        return map(self.nodes.get, range(self.start, self.start + self.length))
+
+
+class BinaryTree:
+    """The queries that our drawing algorithm asks of a binary tree, in terms of
+    the index that each node has in the tree's list representation: the root is at
+    0, and the children of the node at index i are at i*2+1 and i*2+2. The root of
+    the tree is considered to be at level 1. Subclasses store the nodes and provide
+    height, getNodeByIndex, getExistingIndices, nodeExistsByIndex, getLevelView
+    and getLevelBitmap; everything else is worked out from those."""
 
     @staticmethod
     def getMaxNodeCountByLevel(level: int) -> int:
         return 2**(level - 1)
 
-    @classmethod
-    def getLevelStart(cls, level: int) -> int:
-        """Returns the index of the first node that belongs to the given level. Meant
-        to be used to index into self.list"""
-        # can this be turned from log(n) into constant time ??
-        return sum((cls.getMaxNodeCountByLevel(i) for i in range(1, level)),
-                   start=0)
+    @staticmethod
+    def getLevelStart(level: int) -> int:
+        """Returns the index of the first node that belongs to the given level."""
+        # this is the number of nodes in all of the levels above this one
+        return 2**(level - 1) - 1
 
-    def getNodesByLevel(self, level: int) -> list:
-        start = self.getLevelStart(level)
-        return self.list[start:start + self.getMaxNodeCountByLevel(level)]
+    @staticmethod
+    def getLevelOfIndex(index: int) -> int:
+        """Returns the level that the node at the given index is in."""
+        return (index + 1).bit_length()
 
-    def nodeExistsByIndex(self, index: int) -> bool:
-        """Checks for node existence by index, where index is used to look into
-        self.list"""
-        return index < len(self.list) and self.list[index] is not None
+    def getLevelViews(self):
+        """Yields a LevelView (or SparseLevelView) for each level, from the top
+        down."""
+        return (self.getLevelView(level) for level in range(1, self.height + 1))
+
+    def getChildBitmaps(self, level: int) -> tuple:
+        """Returns a pair of bitmaps like the ones from getLevelBitmap, where bit i
+        of the first is set if the node at position i+1 in the given level has a
+        left child, and bit i of the second is set if it has a right child."""
+        below = self.getLevelBitmap(level + 1)
+        if below == 0:
+            return 0, 0
+        # in a string of the level below's bits from least to most significant,
+        # every node's left child is at an even position and its right child at the
+        # odd position after that
+        bits = format(below, "b")[::-1]
+        return int(bits[0::2][::-1], 2), int((bits[1::2] or "0")[::-1], 2)
+
+    def getParentBitmap(self, level: int) -> int:
+        """Returns a bitmap like the ones from getLevelBitmap, where bit i is set if
+        the node at position i+1 in the given level would have a parent if it
+        existed."""
+        if level <= 1:
+            return 0
+        above = self.getLevelBitmap(level - 1)
+        if above == 0:
+            return 0
+        # every bit in the level above covers two in this level
+        return int(format(above, "b").translate({ord("0"): "00", ord("1"): "11"}),
+                   2)
+
+    def countNodes(self) -> int:
+        return sum(1 for _ in self.getExistingIndices())
+
+    def getLabels(self):
+        """Yields the label of every node that exists, in no particular order."""
+        return (self.getNodeByIndex(i) for i in self.getExistingIndices())
 
     def nodeExists(self, level: int, number: int) -> bool:
         """Checks for node existence by position. Both levels and node numbers are
         assumed to start at 1."""
-        nodePos = self.getLevelStart(level) + (number - 1)
+        nodePos = 2**(level - 1) + number - 2
         return self.nodeExistsByIndex(nodePos)
 
     def hasLeftChild(self, level: int, number: int) -> bool:
         """Given the position of a node, returns whether it has a left child or not.
         Both levels and node numbers are assumed to start at 1."""
-        nodePos = self.getLevelStart(level) + (number - 1)
+        nodePos = 2**(level - 1) + number - 2
         childPos = nodePos * 2 + 1
         return self.nodeExistsByIndex(childPos)
 
     def hasRightChild(self, level: int, number: int) -> bool:
         """Given the position of a node, returns whether it has a right child or not.
         Both levels and node numbers are assumed to start at 1."""
-        nodePos = self.getLevelStart(level) + (number - 1)
+        nodePos = 2**(level - 1) + number - 2
         childPos = nodePos * 2 + 2
         return self.nodeExistsByIndex(childPos)
 
@@ -73,14 +159,301 @@ class ListBasedBinaryTree:
         """Given the position of a node which may or may not exist, returns whether
         it would have a parent if it did/does exist. Both levels and node numbers are
         assumed to start at 1."""
-        nodePos = self.getLevelStart(level) + (number - 1)
+        nodePos = 2**(level - 1) + number - 2
         if nodePos < 1:
             return False
         else:
-            parentPos = int((nodePos - 1) / 2)
+            parentPos = (nodePos - 1) // 2
             return self.nodeExistsByIndex(parentPos)
 
 
+class ListBasedBinaryTree(BinaryTree):
+    """List-based binary tree that provides the functions that our drawing algorithm
+    will need."""
+
+    def __init__(self, listRepresentation: list):
+        """
+        Initializes a binary tree based on a list. The list should have None values
+        to signify non-existant nodes.
+        """
+        self.list = listRepresentation
+
+    @property
+    def height(self) -> int:
+        # the first n levels hold 2**n-1 nodes, so the height is the smallest n for
+        # which 2**n-1 is at least the length of the list
+        return len(self.list).bit_length()
+
+    def getNodesByLevel(self, level: int) -> list:
+        start = self.getLevelStart(level)
+        return self.list[start:start + self.getMaxNodeCountByLevel(level)]
+
+    def getLevelView(self, level: int) -> LevelView:
+        """Like getNodesByLevel, but without copying the nodes into a new list, and
+        with None filling out any slots that are past the end of the list."""
+        return LevelView(self.list, self.getLevelStart(level),
+                         self.getMaxNodeCountByLevel(level))
+
+    def getLevelBitmap(self, level: int) -> int:
+        """Returns an int whose bit i (counting from the least significant bit, and
+        from 0) is set if the node at position i+1 in the given level exists."""
+        start = self.getLevelStart(level)
+        end = min(start + self.getMaxNodeCountByLevel(level), len(self.list))
+        if start >= end:
+            return 0
+        return int("".join("0" if self.list[i] is None else "1"
+                           for i in range(end - 1, start - 1, -1)), 2)
+
+    def getNodeByIndex(self, index: int):
+        """Returns the node stored at index, or None if there isn't one."""
+        return self.list[index] if index < len(self.list) else None
+
+    def getExistingIndices(self):
+        """Yields the index of every node that actually exists, in increasing
+        order."""
+        return (i for i, x in enumerate(self.list) if x is not None)
+
+    def countNodes(self) -> int:
+        return len(self.list) - self.list.count(None)
+
+    def getLabels(self):
+        return (x for x in self.list if x is not None)
+
+    def nodeExistsByIndex(self, index: int) -> bool:
+        """Checks for node existence by index, where index is used to look into
+        self.list"""
+        return index < len(self.list) and self.list[index] is not None
+
+
+class SparseBinaryTree(BinaryTree):
+    """A binary tree that only stores the nodes that exist, in a dict that maps the
+    index that each one would have in the list representation to its label. Deep,
+    lopsided trees, whose lists would be mostly None, take up space in proportion
+    to their number of nodes instead of 2**height. This is what the parse functions
+    below build."""
+
+    def __init__(self, nodes: dict):
+        self.nodes = nodes
+
+    @property
+    def height(self) -> int:
+        return (max(self.nodes) + 1).bit_length() if self.nodes else 0
+
+    def getNodesByLevel(self, level: int) -> list:
+        start = self.getLevelStart(level)
+        return [self.nodes.get(i)
+                for i in range(start, start + self.getMaxNodeCountByLevel(level))]
+
+    def getLevelView(self, level: int) -> SparseLevelView:
+        return SparseLevelView(self.nodes, self.getLevelStart(level),
+                               self.getMaxNodeCountByLevel(level))
+
+    def getLevelBitmap(self, level: int) -> int:
+        start = self.getLevelStart(level)
+        end = start + self.getMaxNodeCountByLevel(level)
+        return sum(1 << (i - start) for i in self.nodes if start <= i < end)
+
+    def getNodeByIndex(self, index: int):
+        return self.nodes.get(index)
+
+    def getExistingIndices(self):
+        return iter(sorted(self.nodes))
+
+    def countNodes(self) -> int:
+        return len(self.nodes)
+
+    def getLabels(self):
+        return iter(self.nodes.values())
+
+    def nodeExistsByIndex(self, index: int) -> bool:
+        return index in self.nodes
+
+
+# the compact formats below say which nodes exist with labels, which have to be
+# strings; blank labels mean that there is no node there, as in the list
+# representation (the node is drawn as a ghost if it has descendants). the parse
+# functions take time in proportion to the size of their input, and raise a
+# ValueError if it's malformed, or a TreeTooLargeError if the tree would be taller
+# than maxHeight, which also keeps the indices of deep nodes from getting huge
+
+
+def checkLabel(label) -> bool:
+    """Returns whether a label belongs to a node that exists."""
+    if type(label) is not str:
+        raise ValueError("labels have to be strings")
+    return label.strip() != ""
+
+
+def cleanLabel(label, maxLength: Optional[int] = None) -> Optional[str]:
+    """Strips the whitespace off a label and cuts it down to maxLength characters,
+    unless that is None. Blank labels come out as None, like missing nodes."""
+    if label is None:
+        return None
+    if type(label) is not str:
+        raise ValueError("labels have to be strings")
+    label = label.strip()
+    return label[:maxLength] if label != "" else None
+
+
+def checkDepth(index: int, maxHeight: Optional[int]):
+    if maxHeight is not None and index >= 2**maxHeight - 1:
+        raise TreeTooLargeError(f"tree is more than {maxHeight} levels tall")
+
+
+def parseChildrenTree(root, maxHeight: Optional[int] = None) -> SparseBinaryTree:
+    """Parses a tree of nested dicts, the way that JSON would have it, where each
+    node has a "label" and optional "left" and "right" children, which are nodes
+    or None."""
+    nodes = {}
+    # the tree is walked with a stack instead of recursion so that deep trees
+    # can't overflow Python's stack
+    pending = [(root, 0)]
+    while pending:
+        node, index = pending.pop()
+        if node is None:
+            continue
+        if type(node) is not dict or "label" not in node:
+            raise ValueError("every node needs a label")
+        checkDepth(index, maxHeight)
+        if checkLabel(node["label"]):
+            nodes[index] = node["label"]
+        pending.append((node.get("right"), index * 2 + 2))
+        pending.append((node.get("left"), index * 2 + 1))
+    return SparseBinaryTree(nodes)
+
+
+def parseParentArrays(labels: list, parents: list, sides: str,
+                      maxHeight: Optional[int] = None) -> SparseBinaryTree:
+    """Parses a tree given as parallel arrays, where node i has the label
+    labels[i], is a child of node parents[i] (or is the root, if that is -1) and
+    is its parent's left child if sides[i] is "L" and right child if it is "R".
+    The root's side doesn't matter."""
+    if type(labels) is not list or type(parents) is not list or \
+            type(sides) is not str or not len(labels) == len(parents) == len(sides):
+        raise ValueError("labels, parents and sides should all be as long")
+    # each node's children, as indices into the arrays
+    children = [[None, None] for _ in labels]
+    root = None
+    for i, parent in enumerate(parents):
+        if parent == -1 and type(parent) is int:
+            if root is not None:
+                raise ValueError("tree has more than one root")
+            root = i
+            continue
+        if type(parent) is not int or not 0 <= parent < len(labels) or \
+                sides[i] not in "LR":
+            raise ValueError(f"node {i} has an invalid parent or side")
+        side = 0 if sides[i] == "L" else 1
+        if children[parent][side] is not None:
+            raise ValueError(f"node {parent} has two children on the same side")
+        children[parent][side] = i
+    if root is None:
+        if labels:
+            raise ValueError("tree has no root")
+        return SparseBinaryTree({})
+    nodes = {}
+    visited = 0
+    pending = [(root, 0)]
+    while pending:
+        i, index = pending.pop()
+        visited += 1
+        checkDepth(index, maxHeight)
+        if checkLabel(labels[i]):
+            nodes[index] = labels[i]
+        left, right = children[i]
+        if right is not None:
+            pending.append((right, index * 2 + 2))
+        if left is not None:
+            pending.append((left, index * 2 + 1))
+    if visited != len(labels):
+        # some nodes are in a cycle instead of under the root
+        raise ValueError("not every node is connected to the root")
+    return SparseBinaryTree(nodes)
+
+
+# a label, which might be empty, and the punctuation after it, or the end
+BRACKET_TOKEN = re.compile(r"((?:[^(),\\]|\\.)*)([(),]|$)", re.DOTALL)
+BRACKET_ESCAPE = re.compile(r"\\(.)", re.DOTALL)
+
+
+def parseBracketString(text: str,
+                       maxHeight: Optional[int] = None) -> SparseBinaryTree:
+    """Parses a tree written like A(B(,D),C), where each node is its label
+    followed, if it has children, by its left and right subtrees in parentheses,
+    separated by a comma. Either subtree can be left empty, and a node with only a
+    left child can leave out the comma, as in A(B). Parentheses, commas and
+    backslashes in labels are escaped with backslashes."""
+    if type(text) is not str:
+        raise ValueError("bracket notation has to be a string")
+    nodes = {}
+    # the indices of the nodes whose children are being read
+    parents = []
+    index = 0
+    # whether a subtree has just been closed, so that only a comma or another
+    # closing parenthesis can come next
+    closed = False
+    position = 0
+    while True:
+        match = BRACKET_TOKEN.match(text, position)
+        if match is None:
+            raise ValueError("bracket notation ends with a lone backslash")
+        position = match.end()
+        label, punctuation = match.groups()
+        if closed and (label.strip() != "" or punctuation == "("):
+            raise ValueError(f"unexpected label or ( at position {match.start()}")
+        if label.strip() != "":
+            checkDepth(index, maxHeight)
+            nodes[index] = BRACKET_ESCAPE.sub(r"\1", label)
+        closed = False
+        if punctuation == "(":
+            if maxHeight is not None and len(parents) >= maxHeight:
+                raise TreeTooLargeError(f"tree is more than {maxHeight} levels tall")
+            parents.append(index)
+            index = index * 2 + 1
+        elif punctuation == ",":
+            if not parents or index != parents[-1] * 2 + 1:
+                raise ValueError(f"unexpected , at position {match.end() - 1}")
+            index += 1
+        elif punctuation == ")":
+            if not parents:
+                raise ValueError(f"unexpected ) at position {match.end() - 1}")
+            index = parents.pop()
+            closed = True
+        else:
+            if parents:
+                raise ValueError("bracket notation has unclosed parentheses")
+            return SparseBinaryTree(nodes)
+
+
+def parseCompactTree(spec: dict,
+                     maxHeight: Optional[int] = None) -> Optional[SparseBinaryTree]:
+    """Builds the tree that a tree spec gives in one of the compact formats: a
+    "tree" of nested nodes (see parseChildrenTree), "labels", "parents" and
+    "sides" arrays (see parseParentArrays), or a "brackets" string (see
+    parseBracketString). Returns None if the spec has none of them, and raises a
+    ValueError if it has more than one, or "elements" as well."""
+    formats = [key for key in ("tree", "parents", "brackets") if key in spec]
+    if not formats:
+        return None
+    if len(formats) > 1 or "elements" in spec:
+        raise ValueError("tree spec has more than one representation of the tree")
+    if formats[0] == "tree":
+        return parseChildrenTree(spec["tree"], maxHeight)
+    elif formats[0] == "parents":
+        return parseParentArrays(spec.get("labels"), spec["parents"],
+                                 spec.get("sides"), maxHeight)
+    return parseBracketString(spec["brackets"], maxHeight)
+
+
+def treeFromOptions(options: dict) -> BinaryTree:
+    """Returns the tree in normalized options (see rendering.normalizeTreeSpec),
+    which have either the "elements" of a list representation or the "nodes" of a
+    SparseBinaryTree."""
+    if "nodes" in options:
+        return SparseBinaryTree(options["nodes"])
+    return ListBasedBinaryTree(options["elements"])
+
+
 if __name__ == "__main__":
     # tests!
     assert ListBasedBinaryTree.getMaxNodeCountByLevel(
@@ -100,6 +473,72 @@ if __name__ == "__main__":
     ], "level 2 should have the second and third list items in it"
     assert not test1.isNodeExternal(1, 1), "root node is not external"
     assert test1.isNodeExternal(3, 1), "external node is external"
-    # TODO: tests for left and right child existence
+    assert test1.hasLeftChild(2, 1), "second node has a left child"
+    assert not test1.hasRightChild(2, 1), "second node has no right child"
+    assert not test1.hasLeftChild(2, 2), "third node has no children"
+    assert test1.hasParent(3, 1) and not test1.hasParent(
+        1, 1), "every node but the root has a parent here"
+
+    for length in range(0, 40):
+        assert ListBasedBinaryTree([1] * length).height == max(
+            (level for level in range(0, 10) if 2**(level - 1) <= length),
+            default=0), "closed-form height should match counting levels"
+    for level in range(1, 10):
+        assert ListBasedBinaryTree.getLevelStart(level) == sum(
+            2**(i - 1) for i in range(1, level)), \
+            "closed-form level start should match summing levels"
+
+    test2 = ListBasedBinaryTree(["a", None, "c", None, None, "f"])
+    assert list(test2.getLevelView(3)) == [None, None, "f", None], \
+        "level views should be padded out with Nones"
+    assert test2.getLevelView(2)[-1] == "c", "level views should be indexable"
+    assert test2.getLevelBitmap(3) == 0b0100, "third level has its third node"
+    assert test2.getChildBitmaps(2) == (0b10, 0), \
+        "only the second node in level 2 has a (left) child"
+    assert test2.getParentBitmap(3) == 0b1100, \
+        "the last two nodes in level 3 have a parent"
+    assert [test2.hasParent(3, i) for i in range(1, 5)] == [
+        False, False, True, True], "only the children of existing nodes have parents"
+
+    spec = ["a", None, "c", None, None, "f", None, None, None, None, None, None,
+            "m"]
+    formats = [
+        parseChildrenTree({"label": "a", "right": {
+            "label": "c", "left": {"label": "f", "right": {"label": "m"}}}}),
+        parseParentArrays(["f", "m", "a", "c"], [3, 0, -1, 2], "LR-R"),
+        parseBracketString("a(,c(f(,m)))"),
+    ]
+    for test3 in formats:
+        assert test3.nodes == {i: x for i, x in enumerate(spec) if x is not None}, \
+            "compact formats should put nodes in the same slots as the list"
+        assert test3.height == 4 and test3.getLevelBitmap(3) == 0b0100
+        assert test3.hasParent(4, 6) and not test3.hasParent(4, 1)
+        assert [list(view) for view in test3.getLevelViews()] == [
+            list(view) for view in ListBasedBinaryTree(spec).getLevelViews()], \
+            "sparse level views should read like list ones"
+        assert test3.getLevelView(4)[-2:] == [None, None]
+    assert parseBracketString(r"x\(1\)( , b)").nodes == {0: "x(1)", 2: " b"}, \
+        "escaped labels and blank subtrees should be read right"
+    assert parseBracketString("(a,)").nodes == {1: "a"}, \
+        "blank labels should leave out their nodes"
+    for bad in ("a(b", "a)", "a(b,c,d)", "a(b)c", "a(b)(c)", "a\\"):
+        try:
+            parseBracketString(bad)
+            assert False, f"{bad} should not parse"
+        except ValueError:
+            pass
+    for labels, parents, sides in ((["a", "b"], [-1, -1], "--"),
+                                   (["a", "b", "c"], [-1, 0, 0], "-LL"),
+                                   (["a", "b", "c"], [-1, 2, 1], "-LL")):
+        try:
+            parseParentArrays(labels, parents, sides)
+            assert False, "trees without exactly one root and path to it are bad"
+        except ValueError:
+            pass
+    try:
+        parseBracketString("a(" * 30 + ")" * 30, maxHeight=20)
+        assert False, "trees that are too tall should be turned away"
+    except TreeTooLargeError:
+        pass
 
     print("tests passed")